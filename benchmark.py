@@ -0,0 +1,397 @@
+import argparse, gzip, json, logging, os, platform, random, shutil, subprocess
+import sys, tempfile, time, types
+from datetime import datetime
+
+# Benchmarks every stage of edit_lrt_vsr, create_file_DDI and create_file_SN
+# against synthetic LRTs and a local fake VSR (fake_vsr.py), and writes the
+# timings as JSON so runs from different commits can be compared. The
+# startup cost of the task modules is measured in fresh interpreters.
+#
+#   python benchmark.py --sizes 1000 100000 1000000 --rows 10000
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_ROWS = 5000
+VSR = "vsr-bench"
+DOMAIN = "bench.example.com"
+TABLES = ["R", "S", "B"]
+CARRIERS = {"CARRIER1": ["tgC1", "c1.example.net", "gw1.c1.example.net"]}
+DATA_ARAMIS = {"54": ["AR", "Argentina"], "1": ["US", "United States"]}
+
+
+def install_constants(workdir):
+    # The benchmark never reads the real constants.py: every path points into
+    # workdir and the only VSR is the local fake one
+    paths = {}
+    for name in ["LOG_PATH", "INPUT_PATH", "HISTORY_PATH", "WORKING_PATH"]:
+        paths[name] = os.path.join(workdir, name.split("_")[0].lower())
+    paths["BACKUP_PATH"] = os.path.join(workdir, "backup")
+    for path in paths.values():
+        os.makedirs(path, exist_ok=True)
+    constants = types.ModuleType("constants")
+    constants.__dict__.update(
+        paths,
+        USERNAME="bench",
+        PASSWORD="bench",
+        CARRIERS=CARRIERS,
+        DATA_ARAMIS=DATA_ARAMIS,
+        VSRS={VSR: "127.0.0.1"},
+        VSR_NAME=[VSR],
+        REMOTE_PATH="/code/lrt",
+        DDI_FILE=os.path.join(workdir, "DDI.csv"),
+        SN_FILE=os.path.join(workdir, "SN.csv"),
+    )
+    sys.modules["constants"] = constants
+    return constants
+
+
+def synthetic_lrt(lrt_file, routes, seed=0):
+    from functions_lrt import render_route
+
+    rnd = random.Random(seed)
+    with gzip.open(lrt_file, "wb") as f:
+        f.write(b"<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n")
+        f.write(b"<localRoutes>\n")
+        for i in range(routes):
+            f.write(
+                render_route(
+                    f"54{i:010d}",
+                    f"!(^.*)$!sip:\\1;tgrp=tg{rnd.randrange(100)};"
+                    f"trunk-context={DOMAIN}@gw{rnd.randrange(10)}.example.net!",
+                )
+            )
+        f.write(b"</localRoutes>\n")
+    return os.path.getsize(lrt_file)
+
+
+def synthetic_csv(csv_file, rows, first=0):
+    # Tab separated like the real inputs: number, tgrp, fqdn, key, AS, carrier
+    with open(csv_file, "w", newline="") as f:
+        for i in range(first, first + rows):
+            number = f"1{i:010d}"
+            f.write(
+                f"{number}\ttg{i % 7}\tpbx{i % 3}.example.com\t{i}\tAS{i % 2}"
+                f"\tCARRIER1\n"
+            )
+    return os.path.getsize(csv_file)
+
+
+class Results:
+    def __init__(self):
+        self.records = []
+        # Per-stage TaskMetrics records of the edit_lrt_vsr runs
+        self.task_metrics = []
+
+    def add(self, stage, seconds, routes=None, rows=None, nbytes=None):
+        record = {"stage": stage, "seconds": round(seconds, 6)}
+        if routes is not None:
+            record["routes"] = routes
+        if rows is not None:
+            record["rows"] = rows
+            record["rows_per_s"] = round(rows / seconds, 1) if seconds else None
+        if nbytes is not None:
+            record["bytes"] = nbytes
+            record["mb_per_s"] = round(nbytes / seconds / 1e6, 3) if seconds else None
+        self.records.append(record)
+        print(
+            f"{stage:<24}{routes if routes is not None else '':>10}"
+            f"{seconds:>12.4f}s"
+            f"{'' if nbytes is None else f'{nbytes / 1e6:>12.2f} MB'}"
+        )
+
+
+def timed(results, stage, func, routes=None, rows=None, nbytes=None):
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+    if callable(nbytes):
+        nbytes = nbytes(value)
+    results.add(stage, elapsed, routes, rows, nbytes)
+    return value
+
+
+def bench_lrt_stages(results, constants, fake, sessions, lrt_file, routes, rows_csv):
+    # Times, one by one, the functions edit_lrt_vsr runs on a table
+    import functions_edit_lrt as fel
+    from functions_cache import MIRROR_PATH
+    from functions_index import RouteIndex
+
+    logger = logging.getLogger("benchmark")
+    remote_dir = os.path.join(fake.root, constants.REMOTE_PATH.lstrip("/"))
+    lrt = f"R.{DOMAIN}.xml.gz"
+    r_file = f"{constants.REMOTE_PATH}/{lrt}"
+    mirror_key = (VSR, DOMAIN, "R")
+    edited = os.path.join(os.path.dirname(lrt_file), f"edited_{routes}.xml.gz")
+    new_routes = fel.render_routes("R", fel.read_records(rows_csv), DOMAIN)
+
+    def edit(fin, fout):
+        return fel.generate_lrt(fin, fout, new_routes, logger, RouteIndex(), "skip")
+
+    shutil.copyfile(lrt_file, os.path.join(remote_dir, lrt))
+    shutil.rmtree(MIRROR_PATH, ignore_errors=True)
+    sessions.close_all()
+    timed(results, "connect", lambda: sessions.get_transport("127.0.0.1"), routes)
+    sftp = sessions.open_sftp("127.0.0.1")
+    try:
+        attrs = sftp.stat(r_file)
+        timed(
+            results,
+            "download",
+            lambda: fel.sync_lrt(
+                sftp, constants.REMOTE_PATH, lrt, attrs, mirror_key, logger
+            ),
+            routes,
+            nbytes=attrs.st_size,
+        )
+
+        # Mirror -> staging file, as the edits shared by several VSRs
+        timings = {}
+        timed(
+            results,
+            "edit_lrt_file",
+            lambda: fel.edit_lrt_file(
+                fel.mirror_file(*mirror_key), edited, edit, timings
+            ),
+            routes,
+            rows=len(new_routes),
+            nbytes=attrs.st_size,
+        )
+        for stage in ["gunzip", "edit", "gzip"]:
+            seconds, nbytes = timings[stage]
+            rows = len(new_routes) if stage == "edit" else None
+            results.add(stage, seconds, routes, rows, nbytes)
+
+        size = os.path.getsize(edited)
+        timed(
+            results,
+            "upload",
+            lambda: fel.upload_lrt(sftp, edited, r_file + ".tmp"),
+            routes,
+            nbytes=size,
+        )
+        timed(
+            results,
+            "rename",
+            lambda: fel.replace_remote_file(sftp, r_file + ".tmp", r_file),
+            routes,
+        )
+
+        # VSR -> edit -> VSR in one pass, as the tables no other VSR shares
+        shutil.copyfile(lrt_file, os.path.join(remote_dir, lrt))
+        shutil.rmtree(MIRROR_PATH, ignore_errors=True)
+        attrs = sftp.stat(r_file)
+        timed(
+            results,
+            "stream_edit_lrt",
+            lambda: fel.stream_edit_lrt(
+                sftp,
+                constants.REMOTE_PATH,
+                lrt,
+                attrs,
+                mirror_key,
+                edited,
+                edit,
+                logger,
+            ),
+            routes,
+            rows=len(new_routes),
+            nbytes=attrs.st_size,
+        )
+        fel.replace_remote_file(sftp, r_file + ".tmp", r_file)
+        os.remove(edited)
+    finally:
+        sftp.close()
+
+    def refresh():
+        channel = sessions.open_shell("127.0.0.1")
+        try:
+            return fel.refresh_lrt(channel, [f"R.{DOMAIN}"], logger)
+        finally:
+            channel.close()
+
+    timed(results, "refresh", refresh, routes)
+
+
+def bench_edit_lrt_vsr(results, constants, fake, sessions, lrt_file, routes, csvs):
+    import functions_edit_lrt as fel
+    from functions_cache import MIRROR_PATH
+    from functions_index import INDEX_PATH
+    from functions_metrics import TaskMetrics
+
+    logger = logging.getLogger("benchmark")
+    remote_dir = os.path.join(fake.root, constants.REMOTE_PATH.lstrip("/"))
+    for tab in TABLES:
+        shutil.copyfile(lrt_file, os.path.join(remote_dir, f"{tab}.{DOMAIN}.xml.gz"))
+    shutil.rmtree(MIRROR_PATH, ignore_errors=True)
+    shutil.rmtree(INDEX_PATH, ignore_errors=True)
+    # Cold: nothing cached locally. Warm: same router again, other numbers.
+    for stage, csv_file in zip(["edit_lrt_vsr_cold", "edit_lrt_vsr_warm"], csvs):
+        rows = fel.read_records(csv_file)
+        metrics = TaskMetrics(stage)
+        errors = timed(
+            results,
+            stage,
+            lambda: fel.edit_lrt_vsr(
+                DOMAIN, rows, [VSR], TABLES, logger, sessions=sessions, metrics=metrics
+            ),
+            routes,
+            rows=len(rows) * len(TABLES),
+        )
+        if errors:
+            raise RuntimeError(f"{stage} failed: {errors}")
+        results.task_metrics.append(
+            {"run": stage, "routes": routes, "stages": metrics.records}
+        )
+
+
+def bench_files(results, csv_file, rows):
+    import functions_edit_lrt as fel
+
+    logger = logging.getLogger("benchmark")
+    size = os.path.getsize(csv_file)
+    timed(
+        results,
+        "create_file_DDI",
+        lambda: fel.create_file_DDI(csv_file, "BENCH", logger),
+        rows=rows,
+        nbytes=size,
+    )
+    timed(
+        results,
+        "create_file_SN",
+        lambda: fel.create_file_SN(csv_file, "BENCH", logger),
+        rows=rows,
+        nbytes=size,
+    )
+
+
+# Modules only the tasks that need them should load
+HEAVY_MODULES = ["paramiko", "phonenumbers", "tqdm", "pyfiglet", "socks", "lxml"]
+_STARTUP = """
+import sys, time
+sys.path.insert(0, {here!r})
+import benchmark
+benchmark.install_constants({workdir!r})
+start = time.perf_counter()
+import functions_edit_lrt, functions_jobs
+print(time.perf_counter() - start)
+print(" ".join(m for m in benchmark.HEAVY_MODULES if m in sys.modules))
+"""
+
+
+def bench_startup(results, workdir, repeat=3):
+    # Fresh interpreters importing what edit_lrt.py imports before the menu.
+    # Returns the heavy modules that import pulled in.
+    here = os.path.dirname(os.path.abspath(__file__))
+    bare, imports = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        bare.append(time.perf_counter() - start)
+        out = subprocess.run(
+            [sys.executable, "-c", _STARTUP.format(here=here, workdir=workdir)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.splitlines()
+        imports.append(float(out[0]))
+    results.add("startup_python", min(bare))
+    results.add("startup_import", min(imports))
+    return out[1].split() if len(out) > 1 else []
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmark")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=DEFAULT_SIZES,
+        help=f"Routes in the synthetic LRTs (default: {DEFAULT_SIZES})",
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=DEFAULT_ROWS,
+        help=f"Rows in the synthetic input CSV (default: {DEFAULT_ROWS})",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=f"benchmark_{datetime.now().strftime('%d%m%Y_%H%M%S')}.json",
+        help="JSON file with the results",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the temporary working directory"
+    )
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("TQDM_DISABLE", "1")
+    workdir = tempfile.mkdtemp(prefix="edit_lrt_bench_")
+    constants = install_constants(workdir)
+    logging.getLogger("benchmark").addHandler(logging.NullHandler())
+    logging.getLogger("benchmark").propagate = False
+
+    from fake_vsr import FakeVsr
+    from functions_socks import SessionManager
+
+    results = Results()
+    heavy = bench_startup(results, workdir)
+    remote_root = os.path.join(workdir, "remote")
+    os.makedirs(os.path.join(remote_root, constants.REMOTE_PATH.lstrip("/")))
+    csvs = [os.path.join(constants.INPUT_PATH, f"bench_{i}.csv") for i in (1, 2)]
+    synthetic_csv(csvs[0], args.rows)
+    synthetic_csv(csvs[1], args.rows, first=args.rows)
+    try:
+        with FakeVsr(remote_root, constants.REMOTE_PATH) as fake:
+            with SessionManager(proxy_addr=None, ssh_port=fake.port) as sessions:
+                for routes in args.sizes:
+                    lrt_file = os.path.join(workdir, f"synthetic_{routes}.xml.gz")
+                    timed(
+                        results,
+                        "synthetic_lrt",
+                        lambda: synthetic_lrt(lrt_file, routes),
+                        routes,
+                        nbytes=lambda v: v,
+                    )
+                    bench_lrt_stages(
+                        results, constants, fake, sessions, lrt_file, routes, csvs[0]
+                    )
+                    bench_edit_lrt_vsr(
+                        results, constants, fake, sessions, lrt_file, routes, csvs
+                    )
+                    os.remove(lrt_file)
+        bench_files(results, csvs[0], args.rows)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sizes": args.sizes,
+        "rows": args.rows,
+        "startup_heavy_modules": heavy,
+        "results": results.records,
+        "task_metrics": results.task_metrics,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,13 @@ import os, shutil, sys, argparse
 # from datetime import date, datetime
 
 from functions_edit_lrt import (
+    MAX_WORKERS,
+    OPERATION,
+    OPERATIONS,
     create_custom_logger,
-    read_csv,
+    read_records,
+    iter_records,
+    preflight_input,
     is_csv,
     edit_lrt_vsr,
     create_file_DDI,
@@ -17,24 +22,109 @@ from functions_edit_lrt import (
     input_values_option2,
     input_values_option4,
 )
+from functions_history import HISTORY_DB, ProvisioningHistory
+from functions_jobs import load_jobs, run_jobs
+from functions_index import DUPLICATES, DUPLICATE_POLICIES
+from functions_metrics import TaskMetrics
 from constants import LOG_PATH, INPUT_PATH, DDI_FILE, SN_FILE
 
-
 parser = argparse.ArgumentParser(prog="Daily Tasks")
-parser.add_argument(
+source = parser.add_mutually_exclusive_group(required=True)
+source.add_argument(
     "-f",
     "--file",
     dest="input_file",
-    required=True,
     type=is_csv,
     help="Enter the CSV filename with the data to add",
 )
+source.add_argument(
+    "-j",
+    "--job",
+    dest="job_file",
+    help="Run the jobs of a JSON, YAML or CSV manifest without the menu",
+)
+parser.add_argument(
+    "-w",
+    "--workers",
+    dest="workers",
+    default=MAX_WORKERS,
+    type=int,
+    help=f"Number of VSRs to work at the same time (default: {MAX_WORKERS})",
+)
+parser.add_argument(
+    "-d",
+    "--duplicates",
+    dest="duplicates",
+    default=DUPLICATES,
+    choices=DUPLICATE_POLICIES,
+    help="What to do with numbers already present in the LRT "
+    f"(default: {DUPLICATES})",
+)
+parser.add_argument(
+    "-o",
+    "--operation",
+    dest="operation",
+    default=OPERATION,
+    choices=OPERATIONS,
+    help="Append the routes of the numbers, point them to the new values or "
+    f"remove them; task 1 only, jobs set it per job (default: {OPERATION})",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Continue the interrupted run of the same work instead of starting over",
+)
 args = parser.parse_args()
 
-input_file_fullpath = os.path.join(INPUT_PATH, args.input_file)
-my_csv = read_csv(input_file_fullpath)
+if args.job_file:
+    task = "batch"
+    try:
+        jobs = load_jobs(os.path.join(INPUT_PATH, args.job_file))
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+else:
+    input_file_fullpath = os.path.join(INPUT_PATH, args.input_file)
+    task = print_menu()
+if args.operation != OPERATION and task not in ("1", "q"):
+    parser.error("--operation only applies to task 1; set it per job in job files")
+metrics = TaskMetrics(f"Task_{task}")
+history = ProvisioningHistory(task, args.job_file or args.input_file)
+
+if task == "batch":
+    # Initiate our custom logger for this task
+    my_logger, my_logfile = create_custom_logger("Task_batch", LOG_PATH)
 
-task = print_menu()
+    my_logger.info(
+        "Task inputs: \n"
+        "Task selected: Batch jobs \n"
+        f"Job file: {args.job_file} \n"
+        + "".join(
+            f"Job {n}: task {job['task']}, customer {job['customer'] or '-'}, "
+            f"domain {job['domain'] or '-'}, input file "
+            f"{os.path.basename(job['file'])}, LRT(s) {job['tables']}, "
+            f"Session Router(s) {job['vsrs']} \n"
+            for n, job in enumerate(jobs, 1)
+        )
+    )
+
+    # Executing the task
+    errors = run_jobs(
+        jobs,
+        my_logger,
+        args.workers,
+        duplicates=args.duplicates,
+        metrics=metrics,
+        resume=args.resume,
+        history=history,
+    )
+    if errors:
+        print(f"Task completed with errors in {', '.join(errors)}.")
+        print(f"Please verify logfile {my_logfile}")
+
+elif task in ("1", "3", "4"):
+    # Parsed once and shared by the LRT edit and the DDI/SN file; task 2
+    # streams the input instead
+    my_records = read_records(input_file_fullpath)
 
 if task == "1":
     my_domain, tables, vsrs = input_values_option1()
@@ -45,19 +135,43 @@ if task == "1":
     my_logger.info(
         "Task inputs: \n"
         "Task selected: Configure LRT(s) \n"
+        f"Operation: {args.operation} \n"
         f"Customer domain: {my_domain} \n"
         f"Input file: {args.input_file} \n"
         f"Session Router(s) to work: {vsrs} \n"
         f"LRT(s) to work: {tables} \n"
     )
 
-    # Executing the task
-    errors = edit_lrt_vsr(my_domain, my_csv, vsrs, tables, my_logger)
+    # Executing the task once the whole input passed the preflight
+    # Removing routes only needs the numbers
+    errors = preflight_input(
+        my_records,
+        tables if args.operation != "remove" else [],
+        [],
+        my_logger,
+        metrics,
+    )
+    if not errors:
+        errors = edit_lrt_vsr(
+            my_domain,
+            my_records,
+            vsrs,
+            tables,
+            my_logger,
+            args.workers,
+            duplicates=args.duplicates,
+            metrics=metrics,
+            resume=args.resume,
+            history=history,
+            operation=args.operation,
+        )
     if errors:
-        print(f"Task completed with errors. Please verify logfile {my_logfile}")
+        print(f"Task completed with errors in {', '.join(errors)}.")
+        print(f"Please verify logfile {my_logfile}")
 
 elif task == "2":
     customer = input_values_option2()
+    history.enterprise = customer
 
     # Initiate our custom logger for this task
     my_logger, my_logfile = create_custom_logger("Task_2", LOG_PATH)
@@ -69,12 +183,22 @@ elif task == "2":
         f"Input file: {args.input_file} \n"
     )
 
-    # Executing the task
-    create_file_DDI(input_file_fullpath, customer, my_logger)
-    save_output_file(DDI_FILE, my_logger)
+    # Executing the task once the whole input passed the preflight
+    errors = preflight_input(
+        iter_records(input_file_fullpath), [], ["DDI"], my_logger, metrics
+    )
+    if errors:
+        print(f"Task completed with errors in {', '.join(errors)}.")
+        print(f"Please verify logfile {my_logfile}")
+    else:
+        create_file_DDI(
+            input_file_fullpath, customer, my_logger, metrics, history=history
+        )
+        save_output_file(DDI_FILE, my_logger)
 
 elif task == "3":
     customer = input_values_option2()
+    history.enterprise = customer
     my_domain, tables, vsrs = input_values_option1()
 
     # Initiate our custom logger for this task
@@ -90,16 +214,33 @@ elif task == "3":
         f"LRT(s) to work: {tables} \n"
     )
 
-    # Executing the task
-    errors = edit_lrt_vsr(my_domain, my_csv, vsrs, tables, my_logger)
+    # Executing the task once the whole input passed the preflight
+    errors = preflight_input(my_records, tables, ["DDI"], my_logger, metrics)
+    if not errors:
+        errors = edit_lrt_vsr(
+            my_domain,
+            my_records,
+            vsrs,
+            tables,
+            my_logger,
+            args.workers,
+            duplicates=args.duplicates,
+            metrics=metrics,
+            resume=args.resume,
+            history=history,
+        )
     if errors:
-        print(f"Task completed with errors. Please verify logfile {my_logfile}")
+        print(f"Task completed with errors in {', '.join(errors)}.")
+        print(f"Please verify logfile {my_logfile}")
     else:
-        create_file_DDI(input_file_fullpath, customer, my_logger)
+        create_file_DDI(
+            input_file_fullpath, customer, my_logger, metrics, my_records, history
+        )
         save_output_file(DDI_FILE, my_logger)
 
 elif task == "4":
     customer, my_domain, vsrs = input_values_option4()
+    history.enterprise = customer
 
     # Initiate our custom logger for this task
     my_logger, my_logfile = create_custom_logger("Task_4", LOG_PATH)
@@ -114,13 +255,42 @@ elif task == "4":
         f"LRT(s) to work: ['R'] \n"
     )
 
-    # Executing the task
-    errors = edit_lrt_vsr(my_domain, my_csv, vsrs, ["R"], my_logger)
+    # Executing the task once the whole input passed the preflight
+    errors = preflight_input(my_records, ["R"], ["SN"], my_logger, metrics)
+    if not errors:
+        errors = edit_lrt_vsr(
+            my_domain,
+            my_records,
+            vsrs,
+            ["R"],
+            my_logger,
+            args.workers,
+            duplicates=args.duplicates,
+            metrics=metrics,
+            resume=args.resume,
+            history=history,
+        )
     if errors:
-        print(f"Task completed with errors. Please verify logfile {my_logfile}")
+        print(f"Task completed with errors in {', '.join(errors)}.")
+        print(f"Please verify logfile {my_logfile}")
     else:
-        create_file_SN(input_file_fullpath, customer, my_logger)
+        create_file_SN(
+            input_file_fullpath, customer, my_logger, metrics, my_records, history
+        )
         save_output_file(SN_FILE, my_logger)
 
 elif task == "q":
-    print("Thank you for using this script. Goodbye!")
\ No newline at end of file
+    print("Thank you for using this script. Goodbye!")
+
+if task != "q":
+    # Everything provisioned by the task, in one transaction
+    saved = history.save()
+    if saved:
+        my_logger.info(
+            f"{saved} row(s) of run {history.run_id} saved to the history "
+            f"database {HISTORY_DB}"
+        )
+    # Stage timings of the task, in the log and as JSON next to it
+    my_logger.info(metrics.summary())
+    metrics_file = metrics.write_json(os.path.splitext(my_logfile)[0] + ".json")
+    my_logger.info(f"Metrics file generated: {metrics_file}")
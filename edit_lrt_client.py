@@ -0,0 +1,102 @@
+import argparse, json, sys
+
+# Only the socket client and the policy names are imported: the daemon
+# validates the jobs and does the work, so this script starts in a few
+# milliseconds
+from functions_daemon import SOCKET_PATH, send_request
+from functions_index import DUPLICATE_POLICIES
+
+parser = argparse.ArgumentParser(prog="Edit LRT client")
+parser.add_argument(
+    "-s",
+    "--socket",
+    dest="socket_path",
+    default=SOCKET_PATH,
+    help=f"UNIX socket of the daemon (default: {SOCKET_PATH})",
+)
+command = parser.add_mutually_exclusive_group(required=True)
+command.add_argument(
+    "-j", "--job", dest="job_file", help="Run the jobs of a JSON, YAML or CSV manifest"
+)
+command.add_argument(
+    "-t",
+    "--task",
+    dest="task",
+    choices=["1", "2", "3", "4"],
+    help="Run one task of the menu with the options below",
+)
+command.add_argument("--status", action="store_true", help="Show the daemon status")
+command.add_argument("--stop", action="store_true", help="Stop the daemon")
+parser.add_argument(
+    "-f", "--file", dest="input_file", help="CSV filename with the data to add"
+)
+parser.add_argument("-c", "--customer", dest="customer", help="ENTERPRISE name")
+parser.add_argument("-d", "--domain", dest="domain", help="Customer's domain")
+parser.add_argument("--tables", dest="tables", nargs="+", help="LRT(s) to work")
+parser.add_argument(
+    "-v", "--vsrs", dest="vsrs", nargs="+", help="Session Router(s) to work"
+)
+parser.add_argument(
+    "-o", "--operation", dest="operation", help="add, update or remove (task 1)"
+)
+parser.add_argument(
+    "--duplicates",
+    dest="duplicates",
+    choices=DUPLICATE_POLICIES,
+    help="What to do with numbers already present in the LRT",
+)
+parser.add_argument(
+    "-w", "--workers", dest="workers", type=int, help="Number of VSRs at a time"
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Continue the interrupted run of the same work instead of starting over",
+)
+args = parser.parse_args()
+
+if args.status:
+    request = {"command": "status"}
+elif args.stop:
+    request = {"command": "stop"}
+else:
+    request = {
+        "command": "run",
+        "duplicates": args.duplicates,
+        "workers": args.workers,
+        "resume": args.resume,
+    }
+    if args.job_file:
+        request["job_file"] = args.job_file
+    else:
+        if not args.input_file:
+            parser.error("the following arguments are required: -f")
+        request["jobs"] = [
+            {
+                "task": args.task,
+                "file": args.input_file,
+                "customer": args.customer,
+                "domain": args.domain,
+                "tables": args.tables,
+                "vsrs": args.vsrs,
+                "operation": args.operation,
+            }
+        ]
+
+try:
+    response = send_request(request, args.socket_path)
+except OSError as e:
+    parser.exit(2, f"Daemon not reachable on {args.socket_path}: {e}\n")
+
+if args.status or args.stop:
+    print(json.dumps(response, indent=2))
+elif response["ok"]:
+    print(f"Task completed in {response['seconds']}s (run {response['run_id']})")
+else:
+    print(f"Task completed with errors in {', '.join(response['errors'])}.")
+    for where, errors in response["errors"].items():
+        for error in errors:
+            print(f"  {where}: {error}")
+    if response.get("logfile"):
+        print(f"Please verify logfile {response['logfile']}")
+sys.exit(0 if response["ok"] else 1)
@@ -0,0 +1,55 @@
+import argparse, signal
+
+from functions_daemon import INDEX_CACHE_SIZE, SOCKET_PATH, EditLrtDaemon
+from functions_edit_lrt import MAX_WORKERS, create_custom_logger
+from constants import LOG_PATH, VSR_NAME
+
+parser = argparse.ArgumentParser(prog="Edit LRT daemon")
+parser.add_argument(
+    "-s",
+    "--socket",
+    dest="socket_path",
+    default=SOCKET_PATH,
+    help=f"UNIX socket to listen on (default: {SOCKET_PATH})",
+)
+parser.add_argument(
+    "-w",
+    "--workers",
+    dest="workers",
+    default=MAX_WORKERS,
+    type=int,
+    help=f"Number of VSRs to work at the same time (default: {MAX_WORKERS})",
+)
+parser.add_argument(
+    "--cache",
+    dest="cache",
+    default=INDEX_CACHE_SIZE,
+    type=int,
+    help="Number of LRT route indexes kept in memory " f"(default: {INDEX_CACHE_SIZE})",
+)
+parser.add_argument(
+    "--no-warm",
+    dest="warm",
+    action="store_false",
+    help="Do not connect to every VSR at startup",
+)
+args = parser.parse_args()
+
+# The modules the tasks import lazily are loaded once, before the first task
+import functions_jobs, paramiko, phonenumbers, tqdm
+
+my_logger, my_logfile = create_custom_logger("Daemon", LOG_PATH)
+server = EditLrtDaemon(my_logger, args.socket_path, args.workers, args.cache)
+# SIGTERM stops the daemon like the stop command of the client
+signal.signal(signal.SIGTERM, signal.default_int_handler)
+my_logger.info(f"Listening on {args.socket_path}")
+print(f"Listening on {args.socket_path}, log in {my_logfile}")
+if args.warm:
+    server.warm_up(VSR_NAME)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    my_logger.info("Daemon stopped")
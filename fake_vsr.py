@@ -0,0 +1,182 @@
+import gzip, os, re, socket, threading
+
+import paramiko
+
+# Local stand-in for a VSR: password SSH with an SFTP subsystem over a local
+# directory and a shell that answers "notify lrtd refresh <lrt>" like lrtd.
+# Used by benchmark.py, never by the tasks themselves.
+
+PROMPT = b"vsr-bench# "
+_REFRESH = re.compile(r"notify lrtd refresh (\S+)")
+
+
+class FakeVsrServer(paramiko.ServerInterface):
+    def __init__(self, vsr):
+        self.vsr = vsr
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        threading.Thread(target=self.vsr.shell, args=(channel,), daemon=True).start()
+        return True
+
+
+class FakeSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class FakeSFTPServer(paramiko.SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = server.vsr.root
+
+    def _local(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip("/"))
+
+    def canonicalize(self, path):
+        return os.path.normpath("/" + path).replace("\\", "/")
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._local(path), flags | getattr(os, "O_BINARY", 0), 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "r+b"
+        else:
+            mode = "rb"
+        f = os.fdopen(fd, mode)
+        handle = FakeSFTPHandle(flags)
+        handle.filename = self._local(path)
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._local(newpath)):
+            return paramiko.SFTP_FAILURE
+        os.rename(self._local(oldpath), self._local(newpath))
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        os.replace(self._local(oldpath), self._local(newpath))
+        return paramiko.SFTP_OK
+
+    def list_folder(self, path):
+        folder = self._local(path)
+        attrs = []
+        for name in os.listdir(folder):
+            attr = paramiko.SFTPAttributes.from_stat(
+                os.stat(os.path.join(folder, name))
+            )
+            attr.filename = name
+            attrs.append(attr)
+        return attrs
+
+
+class FakeVsr:
+    # root is the local directory seen as "/" over SFTP; remote_path is where
+    # the refresh looks for <lrt>.xml.gz. Several fake VSRs can share a port
+    # on different loopback hosts (127.0.0.2, ...).
+    def __init__(self, root, remote_path, port=0, host="127.0.0.1"):
+        self.root = root
+        self.remote_path = remote_path
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.sock.listen(50)
+        self._running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                client, addr = self.sock.accept()
+            except OSError:
+                break
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, FakeSFTPServer)
+            transport.start_server(server=FakeVsrServer(self))
+            self.transports.append(transport)
+
+    def count_routes(self, lrt):
+        lrt_file = os.path.join(
+            self.root, self.remote_path.lstrip("/"), lrt + ".xml.gz"
+        )
+        count = 0
+        with gzip.open(lrt_file, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                count += chunk.count(b"</route>")
+        return count
+
+    def shell(self, channel):
+        channel.send(b"Fake VSR for benchmarks\r\n" + PROMPT)
+        pending = b""
+        while True:
+            data = channel.recv(1024)
+            if not data:
+                break
+            pending += data
+            while b"\n" in pending:
+                line, pending = pending.split(b"\n", 1)
+                command = line.decode("ascii", errors="replace").strip()
+                output = command + "\r\n"
+                m = _REFRESH.match(command)
+                if m:
+                    try:
+                        routes = self.count_routes(m.group(1))
+                        output += f"lrtd: {m.group(1)} refreshed, {routes} routes\r\n"
+                    except OSError:
+                        output += f"lrtd: error, {m.group(1)} not found\r\n"
+                channel.send(output.encode("ascii") + PROMPT)
+        channel.close()
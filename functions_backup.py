@@ -0,0 +1,118 @@
+import json, os, threading, time
+from datetime import datetime
+
+from functions_files import link_or_copy
+from constants import BACKUP_PATH
+
+# Backups are stored once per content: blobs/<sha256[:2]>/<sha256>.xml.gz, and
+# manifest.jsonl has one line per backup taken {time, vsr, domain, table,
+# sha256, size}
+BLOB_PATH = os.path.join(BACKUP_PATH, "blobs")
+MANIFEST_FILE = os.path.join(BACKUP_PATH, "manifest.jsonl")
+# Backups always kept for every VSR/LRT, however old they are
+BACKUP_KEEP = 10
+# Older backups beyond BACKUP_KEEP are dropped after this many seconds
+BACKUP_MAX_AGE = 90 * 24 * 3600
+_manifest_lock = threading.Lock()
+
+
+def blob_file(sha256):
+    return os.path.join(BLOB_PATH, sha256[:2], sha256 + ".xml.gz")
+
+
+def store_backup(vsr_name, domain, table, src_file, sha256):
+    # Keeps src_file (an .xml.gz with the given SHA-256) in the store unless
+    # the same content is already there, and records the backup in the manifest
+    blob = blob_file(sha256)
+    if not os.path.exists(blob):
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        link_or_copy(src_file, blob)
+    record = {
+        "time": time.time(),
+        "vsr": vsr_name,
+        "domain": domain,
+        "table": table,
+        "sha256": sha256,
+        "size": os.path.getsize(blob),
+    }
+    with _manifest_lock:
+        os.makedirs(BACKUP_PATH, exist_ok=True)
+        with open(MANIFEST_FILE, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    return record
+
+
+def read_manifest():
+    records = []
+    try:
+        with open(MANIFEST_FILE) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A line cut by a crash in the middle of a write
+                    continue
+    except OSError:
+        pass
+    return records
+
+
+def list_backups(vsr_name=None, domain=None, table=None, before=None):
+    # Backups matching the given filters, oldest first
+    return [
+        r
+        for r in read_manifest()
+        if (vsr_name is None or r["vsr"] == vsr_name)
+        and (domain is None or r["domain"] == domain)
+        and (table is None or r["table"] == table)
+        and (before is None or r["time"] <= before)
+    ]
+
+
+def find_backup(vsr_name, domain, table, before=None, sha256=None):
+    # The latest backup of the LRT taken at or before the given time, or the
+    # latest one whose hash starts with sha256. None when there is none.
+    for r in reversed(list_backups(vsr_name, domain, table, before)):
+        if sha256 is None or r["sha256"].startswith(sha256):
+            return r
+    return None
+
+
+def format_backup(record):
+    when = datetime.fromtimestamp(record["time"]).strftime("%d/%m/%Y %H:%M:%S")
+    return (
+        f"{when}  {record['vsr']:<14}{record['table']}.{record['domain']:<30}"
+        f"{record['sha256'][:12]}  {record['size']:>12}"
+    )
+
+
+def prune_backups(keep=BACKUP_KEEP, max_age=BACKUP_MAX_AGE):
+    # Applies the retention policy to the manifest and removes the blobs no
+    # backup refers to anymore. Returns (backups removed, blobs removed).
+    with _manifest_lock:
+        records = read_manifest()
+        now = time.time()
+        kept = []
+        seen = {}
+        for r in reversed(records):
+            lrt = (r["vsr"], r["domain"], r["table"])
+            seen[lrt] = seen.get(lrt, 0) + 1
+            if seen[lrt] <= keep or now - r["time"] <= max_age:
+                kept.append(r)
+        kept.reverse()
+        if len(kept) < len(records):
+            with open(MANIFEST_FILE + ".tmp", "w") as f:
+                for r in kept:
+                    f.write(json.dumps(r) + "\n")
+            os.replace(MANIFEST_FILE + ".tmp", MANIFEST_FILE)
+        used = {r["sha256"] for r in kept}
+        blobs = 0
+        if os.path.isdir(BLOB_PATH):
+            for folder in os.listdir(BLOB_PATH):
+                for name in os.listdir(os.path.join(BLOB_PATH, folder)):
+                    if name.endswith(".tmp"):
+                        continue
+                    if name.split(".")[0] not in used:
+                        os.remove(os.path.join(BLOB_PATH, folder, name))
+                        blobs += 1
+    return len(records) - len(kept), blobs
@@ -0,0 +1,146 @@
+import json, os, threading, time
+from concurrent.futures import Future
+
+from constants import WORKING_PATH
+
+MIRROR_PATH = os.path.join(WORKING_PATH, "mirror")
+# Edited LRTs waiting to be uploaded to every VSR that shares them
+STAGING_PATH = os.path.join(WORKING_PATH, "staging")
+# Mirror entries older than this (seconds since last use) are evicted
+MIRROR_MAX_AGE = 7 * 24 * 3600
+# Total bytes kept in the mirror; least recently used entries go first
+MIRROR_MAX_SIZE = 2 * 1024**3
+
+
+def mirror_file(vsr_name, domain, table):
+    return os.path.join(MIRROR_PATH, vsr_name, f"{table}.{domain}.xml.gz")
+
+
+def load_mirror(vsr_name, domain, table, attrs):
+    # Returns the mirror metadata when the local copy still matches the
+    # remote size and mtime, None when the LRT has to be downloaded
+    lrt_file = mirror_file(vsr_name, domain, table)
+    try:
+        with open(lrt_file + ".json") as f:
+            meta = json.load(f)
+        size = os.path.getsize(lrt_file)
+    except (OSError, ValueError):
+        return None
+    if (
+        size != meta.get("size")
+        or meta.get("size") != attrs.st_size
+        or meta.get("mtime") != attrs.st_mtime
+    ):
+        return None
+    meta["used"] = time.time()
+    _write_meta(lrt_file, meta)
+    return meta
+
+
+def save_mirror(vsr_name, domain, table, src_file, attrs, sha256):
+    # Moves src_file (a complete .xml.gz) into the mirror as the copy
+    # matching the remote attrs
+    lrt_file = mirror_file(vsr_name, domain, table)
+    os.makedirs(os.path.dirname(lrt_file), exist_ok=True)
+    os.replace(src_file, lrt_file)
+    now = time.time()
+    meta = {
+        "size": attrs.st_size,
+        "mtime": attrs.st_mtime,
+        "sha256": sha256,
+        "stored": now,
+        "used": now,
+    }
+    _write_meta(lrt_file, meta)
+    return meta
+
+
+def _write_meta(lrt_file, meta):
+    with open(lrt_file + ".json.tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(lrt_file + ".json.tmp", lrt_file + ".json")
+
+
+def evict_mirror(max_age=MIRROR_MAX_AGE, max_size=MIRROR_MAX_SIZE):
+    # Returns the number of mirror entries removed
+    if not os.path.isdir(MIRROR_PATH):
+        return 0
+    entries = []
+    for vsr_name in os.listdir(MIRROR_PATH):
+        vsr_path = os.path.join(MIRROR_PATH, vsr_name)
+        if not os.path.isdir(vsr_path):
+            continue
+        for name in os.listdir(vsr_path):
+            if not name.endswith(".xml.gz"):
+                continue
+            lrt_file = os.path.join(vsr_path, name)
+            try:
+                with open(lrt_file + ".json") as f:
+                    used = json.load(f).get("used", 0)
+                size = os.path.getsize(lrt_file)
+            except (OSError, ValueError):
+                used, size = 0, 0
+            entries.append((used, size, lrt_file))
+    entries.sort()
+    now = time.time()
+    total = sum(size for used, size, lrt_file in entries)
+    removed = 0
+    for used, size, lrt_file in entries:
+        if now - used <= max_age and total <= max_size:
+            break
+        for f in (lrt_file, lrt_file + ".json"):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+        total -= size
+        removed += 1
+    return removed
+
+
+class SharedEdits:
+    # Edits shared by the VSRs holding byte-identical copies of an LRT: the
+    # first VSR asking for a key runs the edit, the others wait for its result.
+    # shared holds the (domain, table, routes_sha256) given to more than one
+    # VSR, the only ones worth staging.
+    def __init__(self, shared=()):
+        self.shared = set(shared)
+        self._futures = {}
+        self._files = []
+        self._lock = threading.Lock()
+
+    def staging_file(self, domain, table, src_sha256, routes_sha256):
+        return os.path.join(
+            STAGING_PATH,
+            f"{table}.{domain}.{src_sha256[:16]}.{routes_sha256[:16]}.xml.gz",
+        )
+
+    def is_shared(self, domain, table, routes_sha256):
+        return (domain, table, routes_sha256) in self.shared
+
+    def get(self, key, edit):
+        # Returns (True, result) to the VSR that ran edit, (False, result) to
+        # the others. An exception raised by edit is raised to all of them.
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+                self._files.append(self.staging_file(*key))
+        if owner:
+            os.makedirs(STAGING_PATH, exist_ok=True)
+            try:
+                future.set_result(edit())
+            except BaseException as e:
+                future.set_exception(e)
+        return owner, future.result()
+
+    def cleanup(self):
+        with self._lock:
+            files, self._files = self._files, []
+            self._futures.clear()
+        for f in files:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
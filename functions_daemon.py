@@ -0,0 +1,213 @@
+import json, os, socket, socketserver, threading, time
+
+from constants import WORKING_PATH
+
+# edit_lrt_daemon.py keeps the imports, the SSH sessions to the VSRs and the
+# route indexes of the last LRTs worked between tasks, and takes the tasks
+# of edit_lrt_client.py on this UNIX socket: one JSON request per
+# connection, answered with one JSON line once it is done
+SOCKET_PATH = os.path.join(WORKING_PATH, "edit_lrt.sock")
+# Route indexes kept in memory by the daemon
+INDEX_CACHE_SIZE = 64
+# Seconds the client waits for a task before giving up
+CLIENT_TIMEOUT = 6 * 3600
+
+
+def send_request(request, socket_path=SOCKET_PATH, timeout=CLIENT_TIMEOUT):
+    # Client side: returns the response of the daemon to request
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    if not data:
+        raise EOFError("No response from the daemon")
+    return json.loads(data)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.dispatch(request)
+        except Exception as e:
+            self.server.logger.exception(f"Request failed: {e}")
+            response = {"ok": False, "errors": {"daemon": [f"{type(e).__name__}: {e}"]}}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class EditLrtDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Tasks run one at a time, in the order they arrive; status answers
+    # while a task runs
+    daemon_threads = True
+
+    def __init__(
+        self,
+        logger_name,
+        socket_path=SOCKET_PATH,
+        max_workers=None,
+        index_cache_size=INDEX_CACHE_SIZE,
+        sessions=None,
+    ):
+        from functions_edit_lrt import MAX_WORKERS
+        from functions_index import set_index_cache_size
+        from functions_socks import SessionManager
+
+        self.logger = logger_name
+        self.socket_path = socket_path
+        self.max_workers = max_workers or MAX_WORKERS
+        self.sessions = sessions if sessions is not None else SessionManager()
+        self.started = time.time()
+        self.runs = 0
+        self._task_lock = threading.Lock()
+        set_index_cache_size(index_cache_size)
+        if os.path.exists(socket_path):
+            # A socket left by a daemon that did not stop cleanly
+            try:
+                send_request({"command": "status"}, socket_path, timeout=5)
+            except OSError:
+                os.remove(socket_path)
+            else:
+                raise RuntimeError(f"A daemon is already listening on {socket_path}")
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        super().__init__(socket_path, _RequestHandler)
+        os.chmod(socket_path, 0o600)
+
+    def warm_up(self, vsrs):
+        # Opens the sessions to the VSRs in the background, so the first task
+        # does not wait for the handshakes
+        from constants import VSRS
+
+        def connect(vsr_name):
+            try:
+                self.sessions.get_transport(VSRS.get(vsr_name))
+                self.logger.info(f"Session to {vsr_name} ready")
+            except Exception as e:
+                self.logger.error(f"Session to {vsr_name} failed: {e}")
+
+        for vsr_name in vsrs:
+            threading.Thread(target=connect, args=(vsr_name,), daemon=True).start()
+
+    def dispatch(self, request):
+        command = request.get("command")
+        if command == "run":
+            return self.run_task(request)
+        if command == "status":
+            return self.status()
+        if command == "stop":
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return {"ok": True}
+        return {"ok": False, "errors": {"request": [f"Unknown command {command!r}"]}}
+
+    def status(self):
+        from functions_index import index_cache_len
+
+        return {
+            "ok": True,
+            "pid": os.getpid(),
+            "uptime": round(time.time() - self.started, 1),
+            "runs": self.runs,
+            "busy": self._task_lock.locked(),
+            "sessions": self.sessions.active_hosts(),
+            "cached_indexes": index_cache_len(),
+        }
+
+    def run_task(self, request):
+        # request holds the jobs (as in a job file) or the job_file to read,
+        # and the duplicates/resume/workers options of edit_lrt.py
+        from functions_edit_lrt import create_custom_logger
+        from functions_history import ProvisioningHistory
+        from functions_index import DUPLICATES, DUPLICATE_POLICIES
+        from functions_jobs import load_jobs, parse_jobs, run_jobs
+        from functions_metrics import TaskMetrics
+        from constants import INPUT_PATH, LOG_PATH
+
+        try:
+            if request.get("job_file"):
+                source = request["job_file"]
+                jobs = load_jobs(os.path.join(INPUT_PATH, source))
+            else:
+                source = "client"
+                jobs = parse_jobs(request.get("jobs") or [])
+            if not jobs:
+                raise ValueError("No job to run")
+        except (OSError, ValueError) as e:
+            return {"ok": False, "errors": {"jobs": [str(e)]}}
+        duplicates = request.get("duplicates") or DUPLICATES
+        if duplicates not in DUPLICATE_POLICIES:
+            return {
+                "ok": False,
+                "errors": {
+                    "request": [
+                        f"Unknown duplicates policy {duplicates!r}, expected one "
+                        f"of {', '.join(DUPLICATE_POLICIES)}"
+                    ]
+                },
+            }
+
+        with self._task_lock:
+            start = time.perf_counter()
+            my_logger, my_logfile = create_custom_logger("Task_daemon", LOG_PATH)
+            metrics = TaskMetrics("Task_daemon")
+            history = ProvisioningHistory("daemon", source)
+            try:
+                my_logger.info(
+                    "Task inputs: \n"
+                    "Task selected: Daemon jobs \n"
+                    f"Source: {source} \n"
+                    + "".join(
+                        f"Job {n}: task {job['task']}, operation "
+                        f"{job['operation']}, customer {job['customer'] or '-'}, "
+                        f"domain {job['domain'] or '-'}, input file "
+                        f"{os.path.basename(job['file'])}, LRT(s) {job['tables']}, "
+                        f"Session Router(s) {job['vsrs']} \n"
+                        for n, job in enumerate(jobs, 1)
+                    )
+                )
+                errors = run_jobs(
+                    jobs,
+                    my_logger,
+                    request.get("workers") or self.max_workers,
+                    duplicates=duplicates,
+                    metrics=metrics,
+                    sessions=self.sessions,
+                    resume=bool(request.get("resume")),
+                    history=history,
+                )
+                history.save()
+                my_logger.info(metrics.summary())
+                metrics.write_json(os.path.splitext(my_logfile)[0] + ".json")
+            except Exception as e:
+                my_logger.exception(f"Task failed: {e}")
+                errors = {"daemon": [f"{type(e).__name__}: {e}"]}
+            finally:
+                # The logger outlives the task, its file must not
+                for handler in list(my_logger.handlers):
+                    my_logger.removeHandler(handler)
+                    handler.close()
+            self.runs += 1
+            seconds = time.perf_counter() - start
+        self.logger.info(
+            f"Task from {source} done in {seconds:.1f}s"
+            + (f", errors in {', '.join(errors)}" if errors else "")
+        )
+        return {
+            "ok": not errors,
+            "errors": errors,
+            "logfile": my_logfile,
+            "run_id": history.run_id,
+            "seconds": round(seconds, 3),
+        }
+
+    def server_close(self):
+        super().server_close()
+        self.sessions.close_all()
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
@@ -1,12 +1,35 @@
-import csv, os, gzip, logging, shutil, re, time
+import argparse, csv, hashlib, locale, os, logging, shutil, re, socket, time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 
-import phonenumbers
-from lxml import etree
 from datetime import date, datetime
-from pyfiglet import Figlet
-from tqdm import tqdm
 
-from functions_socks import create_sftp_connection, create_ssh_connection
+from functions_backup import blob_file, find_backup, prune_backups, store_backup
+from functions_cache import (
+    SharedEdits,
+    evict_mirror,
+    load_mirror,
+    mirror_file,
+    save_mirror,
+)
+from functions_files import link_or_copy
+from functions_index import (
+    DUPLICATES,
+    DuplicateRouteError,
+    find_duplicates,
+    load_route_index,
+    save_route_index,
+)
+from functions_journal import RunJournal, file_attrs, prune_journals
+from functions_lrt import (
+    HashSink,
+    edit_gzip_stream,
+    rewrite_routes,
+    splice_routes,
+)
+from functions_metrics import TaskMetrics
+from functions_transfer import TRANSFER_BUFFER, TransferPool, transfer_rate
 from constants import (
     CARRIERS,
     DDI_FILE,
@@ -15,11 +38,95 @@ from constants import (
     DATA_ARAMIS,
     VSR_NAME,
     VSRS,
-    WORKING_PATH,
-    BACKUP_PATH,
     REMOTE_PATH,
 )
 
+# Number of VSRs worked at the same time by edit_lrt_vsr
+MAX_WORKERS = 4
+# What a run does with the numbers of the input: append their routes, point
+# the routes already in the LRT to the new next, or drop them
+OPERATION = "add"
+OPERATIONS = ["add", "update", "remove"]
+# Seconds to wait for the VSR prompt after every lrtd refresh
+REFRESH_TIMEOUT = 120
+
+# Lengths of the country and national parts of a number resolved from the
+# country code table without phonenumbers.parse
+MAX_LENGTH_CC = 3
+MIN_LENGTH_NSN = 2
+MAX_LENGTH_NSN = 17
+# Digits of a valid number within the limits above, with no leading 0
+_E164 = re.compile(
+    rf"[1-9][0-9]{{{MIN_LENGTH_NSN},{MAX_LENGTH_CC + MAX_LENGTH_NSN - 1}}}"
+)
+_COUNTRY_PREFIXES = None
+
+# LRTs that can be edited. columns maps the template fields to InputRecord
+# fields, lookups replaces a field by the values found for it in another table
+# and template renders the <next> regex (domain is always available).
+LRT_TABLES = {
+    "R": {
+        "columns": {"number": "number", "tgrp": "tgrp", "fqdn": "fqdn"},
+        "template": "!(^.*)$!sip:\\1;tgrp={tgrp};trunk-context={domain}@{fqdn}!",
+    },
+    "S": {
+        "columns": {"number": "number", "tgrp": "key", "as_cluster": "as_cluster"},
+        "template": "!(^.*)$!sip:\\1;key={tgrp}@{as_cluster}Cluster!",
+    },
+    "B": {
+        "columns": {"number": "number", "carrier": "carrier"},
+        "lookups": {"carrier": (CARRIERS, ["tgrp", "tcontext", "fqdn"])},
+        "template": "!(^.*)$!sip:\\1;tgrp={tgrp};trunk-context={tcontext}@{fqdn}!",
+    },
+}
+
+# Rows buffered per output file before each csv writerows call
+BATCH_SIZE = 5000
+ARAMIS_HEADER = [
+    "Source ID",
+    "Source",
+    "ISO Code",
+    "Country",
+    "Digits",
+    "Last Modification",
+    "Source Type",
+    "Mask",
+    "Mask Active",
+    "CPC",
+    "NumA",
+    "Group Country NumA",
+    "Business Unit",
+    "MNC",
+    "Rate",
+    "Billing Increments",
+]
+# Output files generated from the input CSV. digits lists, per line written,
+# the InputRecord field with the digits, the Source Type and the exact number
+# of columns the input row must have for that line (None: always)
+ARAMIS_EXPORTS = {
+    "DDI": {
+        "file": DDI_FILE,
+        "source": "DDI-Bidirectional",
+        "desc": "Generating DDI file",
+        "digits": [("number", "Fixed", None)],
+    },
+    "SN": {
+        "file": SN_FILE,
+        "source": "Special-Numbers",
+        "desc": "Generating Special Number file",
+        "digits": [("fixed", "Fixed", None), ("mobile", "Mobile", 5)],
+    },
+}
+
+_PROMPT = re.compile(r"([^\r\n]*[#>$]) ?$")
+_ROUTES = re.compile(r"(\d+)\s+routes|routes\D{0,3}(\d+)", re.IGNORECASE)
+_REFRESH_ERROR = re.compile(r"error|fail|not found|invalid", re.IGNORECASE)
+
+
+class VsrLoggerAdapter(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[{self.extra['vsr']}] {msg}", kwargs
+
 
 def create_custom_logger(logger_name, log_path):
 
@@ -41,10 +148,92 @@ def create_custom_logger(logger_name, log_path):
     return logger, log_file
 
 
-def read_csv(file):
+class InputRecord:
+    # One row of the tab separated input. Columns 3 and 4 hold the S key and
+    # AS cluster for the LRTs, or the fixed and mobile special numbers for the
+    # SN file. width is the number of columns the row had, line where it was.
+    __slots__ = (
+        "number",
+        "tgrp",
+        "fqdn",
+        "key",
+        "as_cluster",
+        "carrier",
+        "width",
+        "line",
+    )
+    FIELDS = __slots__[:-2]
+    ALIASES = {"fixed": "key", "mobile": "as_cluster"}
+
+    def __init__(self, row, line=None):
+        self.width = len(row)
+        self.line = line
+        for field, value in zip(self.FIELDS, row):
+            setattr(self, field, value)
+        for field in self.FIELDS[len(row) :]:
+            setattr(self, field, None)
+
+    @property
+    def fixed(self):
+        return self.key
+
+    @property
+    def mobile(self):
+        return self.as_cluster
+
+    def __repr__(self):
+        return f"InputRecord({[getattr(self, f) for f in self.FIELDS[:self.width]]})"
+
+
+def parse_records(lines):
+    # Lazily parses tab separated text lines into InputRecords, skipping blank
+    # lines. Validating them is left to preflight.
+    reader = csv.reader(lines, delimiter="\t")
+    for row in reader:
+        if row and any(row):
+            yield InputRecord(row, reader.line_num)
+
+
+def iter_records(file):
+    # Streams the records of the input file, for files too big to hold
     with open(file, "r") as f:
-        reader = list(csv.reader(f, delimiter="\t"))
-    return reader
+        yield from parse_records(f)
+
+
+def read_records(file):
+    # Parses the input once, so every stage of a task shares the same records
+    return list(iter_records(file))
+
+
+def field_width(field):
+    # Columns a row needs to have the given InputRecord field
+    return InputRecord.FIELDS.index(InputRecord.ALIASES.get(field, field)) + 1
+
+
+def needed_fields(tables=(), exports=()):
+    # {field: columns needed} for the selected LRTs and ARAMIS exports; the
+    # digits only written for rows of an exact width are left out
+    needed = {}
+    for tab in tables:
+        for field in LRT_TABLES[tab]["columns"].values():
+            needed[field] = field_width(field)
+    for kind in exports:
+        for field, source_type, width in ARAMIS_EXPORTS[kind]["digits"]:
+            if width is None:
+                needed[field] = field_width(field)
+    return needed
+
+
+def check_records(records, tables):
+    # Raises ValueError for the first record lacking a column the tables use
+    needed = needed_fields(tables)
+    for record in records:
+        for field, width in needed.items():
+            if record.width < width:
+                raise ValueError(
+                    f"Number {record.number}: {width} columns needed for "
+                    f"{field}, found {record.width}"
+                )
 
 
 def is_csv(file):
@@ -55,230 +244,988 @@ def is_csv(file):
         raise argparse.ArgumentTypeError(msg)
 
 
-def gunzip_lrt(input_file, logger_name):
-    output_file = input_file.rstrip(".gz")
-    with gzip.open(input_file, "rt") as fin:
-        with open(output_file, "w") as fout:
-            fout.write(fin.read())
-    logger_name.info(
-        "Successfully gunzip file {} to file {}".format(input_file, output_file)
-    )
-    os.remove(input_file)
-    return output_file
-
-
-def gzip_lrt(input_file, logger_name):
-    output_file = input_file + ".gz"
-    with open(input_file, "r") as fin:
-        with gzip.open(output_file, "wt") as fout:
-            fout.write(fin.read())
-    logger_name.info(
-        "Successfully gzip file {} to file {}".format(input_file, output_file)
+def parse_time(value):
+    # Seconds since the epoch of a dd/mm/YYYY [HH:MM:SS] command line value
+    for fmt in ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(
+        f"{value} is not a valid time (dd/mm/YYYY or dd/mm/YYYY HH:MM:SS)"
     )
-    os.remove(input_file)
-    return output_file
 
 
-def download_lrt(host, l_path, r_path, lrts, logger_name):
-    mysftp, mytransport = create_sftp_connection(host)
-    mysftp.chdir(r_path)
-    fails = 0
-    for lrt in tqdm(lrts, desc="Downloading LRT(s)", leave=False):
-        r_file = r_path + "/" + lrt
-        l_file = l_path + "\\" + lrt
+def stat_lrt(sftp, r_path, lrts, logger_name):
+    # Returns {lrt: SFTPAttributes} for the LRTs found in r_path
+    stats = {}
+    for lrt in lrts:
         try:
-            mysftp.get(r_file, l_file)
+            stats[lrt] = sftp.stat(r_path + "/" + lrt)
         except IOError:
             logger_name.info(f"LRT {lrt} not found.")
-            fails += 1
-        else:
-            logger_name.info(f"Successfully downloaded LRT: {lrt}")
-    mysftp.close()
-    mytransport.close()
-    return fails
+    return stats
+
+
+def _rename_unsupported(error):
+    # paramiko raises SFTP_OP_UNSUPPORTED as an IOError with no errno and the
+    # server's message, "Operation unsupported" on OpenSSH
+    return error.errno is None and "unsupported" in str(error).lower()
+
 
+def replace_remote_file(sftp, src, dst):
+    # Swaps src in for dst with posix-rename, atomic on the VSR. Any error
+    # leaves dst as it was.
+    try:
+        sftp.posix_rename(src, dst)
+        return
+    except IOError as e:
+        if not _rename_unsupported(e):
+            raise
+    # Servers without the extension refuse to rename over dst, so dst is
+    # moved aside first and put back if src cannot take its place
+    old = dst + ".old"
+    remove_remote_file(sftp, old)
+    try:
+        sftp.rename(dst, old)
+    except FileNotFoundError:
+        old = None
+    try:
+        sftp.rename(src, dst)
+    except IOError:
+        if old is not None:
+            sftp.rename(old, dst)
+        raise
+    if old is not None:
+        remove_remote_file(sftp, old)
 
-def upload_lrt(host, l_path, r_path, lrts, logger_name):
-    mysftp, mytransport = create_sftp_connection(host)
-    mysftp.chdir(r_path)
-    for lrt in tqdm(lrts, desc="Uploading LRT(s)", leave=False):
-        r_file = r_path + "/" + lrt
-        l_file = l_path + "\\" + lrt
-        mysftp.put(l_file, r_file)
-        logger_name.info(f"Successfully uploaded LRT: {lrt}")
-    mysftp.close()
-    mytransport.close()
-
-
-def generate_lrt_R(lrt_file, csv_file, domain, logger_name):
-    tree = etree.parse(lrt_file)
-    root = tree.getroot()
-    logger_name.info(f"Total entries: {len(root)}")
-    count = 0
-    for row in tqdm(csv_file, desc="Adding entries", leave=False):
-        number, tgrp, fqdn = row[0], row[1], row[2]
-        route_elem = etree.SubElement(root, "route")
-        user_elem = etree.SubElement(route_elem, "user")
-        next_elem = etree.SubElement(route_elem, "next")
-        user_elem.set("type", "E164")
-        next_elem.set("type", "regex")
-        user_elem.text = number
-        next_elem.text = f"!(^.*)$!sip:\\1;tgrp={tgrp};trunk-context={domain}@{fqdn}!"
-        count += 1
-        time.sleep(0.05)
-
-    etree.indent(tree)
-    xml_data = etree.tostring(
-        tree,
-        pretty_print=True,
-        xml_declaration=True,
-        encoding="UTF-8",
-        standalone=True,
+
+def remove_remote_file(sftp, r_file):
+    try:
+        sftp.remove(r_file)
+    except IOError:
+        pass
+
+
+def sync_lrt(sftp, r_path, lrt, attrs, mirror_key, logger_name, timings=None):
+    # Makes the local mirror of lrt match the remote attrs, downloading (and
+    # hashing) it only when it changed. Returns the mirror metadata.
+    mirror = mirror_file(*mirror_key)
+    meta = load_mirror(*mirror_key, attrs)
+    if meta is not None and meta.get("sha256"):
+        logger_name.info(f"LRT {lrt} unchanged since last run, read from {mirror}")
+        return meta
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+    in_hash = HashSink()
+    start = time.perf_counter()
+    try:
+        with sftp.open(r_path + "/" + lrt, "rb") as fin:
+            fin.prefetch(attrs.st_size)
+            with open(mirror + ".part", "wb") as fout:
+                for chunk in iter(lambda: fin.read(TRANSFER_BUFFER), b""):
+                    fout.write(chunk)
+                    in_hash.write(chunk)
+        if in_hash.size != attrs.st_size:
+            raise IOError(
+                f"Read {in_hash.size} bytes of {lrt}, expected {attrs.st_size}"
+            )
+    except Exception:
+        if os.path.exists(mirror + ".part"):
+            os.remove(mirror + ".part")
+        raise
+    seconds = time.perf_counter() - start
+    if timings is not None:
+        timings["download"] = (seconds, attrs.st_size)
+    logger_name.info(
+        f"LRT {lrt} downloaded to {mirror}, {transfer_rate(seconds, attrs.st_size)}"
     )
+    return save_mirror(*mirror_key, mirror + ".part", attrs, in_hash.hexdigest())
 
-    with open(lrt_file, "wb") as f:
-        f.write(xml_data)
 
-    logger_name.info(f"Entries added: {count}")
-    logger_name.info(f"New total entries: {len(root)}")
-
-
-def generate_lrt_S(lrt_file, csv_file, logger_name):
-    tree = etree.parse(lrt_file)
-    root = tree.getroot()
-    logger_name.info(f"Total entries: {len(root)}")
-    count = 0
-    for row in tqdm(csv_file, desc="Adding entries", leave=False):
-        number, tgrp, as_cluster = row[0], row[3], row[4]
-        route_elem = etree.SubElement(root, "route")
-        user_elem = etree.SubElement(route_elem, "user")
-        next_elem = etree.SubElement(route_elem, "next")
-        user_elem.set("type", "E164")
-        next_elem.set("type", "regex")
-        user_elem.text = number
-        next_elem.text = f"!(^.*)$!sip:\\1;key={tgrp}@{as_cluster}Cluster!"
-        count += 1
-        time.sleep(0.05)
-
-    etree.indent(tree)
-    xml_data = etree.tostring(
-        tree,
-        pretty_print=True,
-        xml_declaration=True,
-        encoding="UTF-8",
-        standalone=True,
+def stream_edit_lrt(
+    sftp, r_path, lrt, attrs, mirror_key, out_file, edit, logger_name, timings=None
+):
+    # Local mirror (while it still matches the remote attrs) or remote .xml.gz
+    # -> gunzip -> edit -> gzip -> remote temporary file, in one pass. On a
+    # mirror miss the source is teed to the mirror, and the edited .xml.gz is
+    # teed to out_file. Returns the mirror metadata, the SHA-256 of the
+    # edited .xml.gz and the result of edit.
+    r_file = r_path + "/" + lrt
+    r_tmp = r_file + ".tmp"
+    mirror = mirror_file(*mirror_key)
+    meta = load_mirror(*mirror_key, attrs)
+    cached = meta is not None and bool(meta.get("sha256"))
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+    if timings is None:
+        timings = {}
+    in_hash = HashSink()
+    out_hash = HashSink()
+    start = time.perf_counter()
+    try:
+        with ExitStack() as stack:
+            in_sinks = []
+            if cached:
+                fin = stack.enter_context(open(mirror, "rb"))
+            else:
+                fin = stack.enter_context(sftp.open(r_file, "rb"))
+                fin.prefetch(attrs.st_size)
+                in_sinks = [stack.enter_context(open(mirror + ".part", "wb")), in_hash]
+            fout = stack.enter_context(sftp.open(r_tmp, "wb"))
+            fout.set_pipelined(True)
+            out_sinks = [stack.enter_context(open(out_file, "wb")), out_hash]
+            result = edit_gzip_stream(
+                fin, fout, edit, in_sinks, out_sinks, timings=timings
+            )
+        if not cached and in_hash.size != attrs.st_size:
+            raise IOError(
+                f"Read {in_hash.size} bytes of {lrt}, expected {attrs.st_size}"
+            )
+    except Exception:
+        remove_remote_file(sftp, r_tmp)
+        for f in (mirror + ".part", out_file):
+            if os.path.exists(f):
+                os.remove(f)
+        raise
+    seconds = time.perf_counter() - start
+    timings["mirror" if cached else "download"] = timings.pop("read")
+    timings["upload"] = timings.pop("write")
+    if cached:
+        logger_name.info(f"LRT {lrt} unchanged since last run, read from {mirror}")
+    else:
+        meta = save_mirror(*mirror_key, mirror + ".part", attrs, in_hash.hexdigest())
+        logger_name.info(f"LRT {lrt} downloaded to {mirror}")
+    logger_name.info(
+        f"Successfully streamed LRT {lrt} to {r_tmp}, "
+        f"{transfer_rate(seconds, out_hash.size)}"
     )
+    return meta, out_hash.hexdigest(), result
+
+
+def edit_lrt_file(src_file, dst_file, edit, timings=None):
+    # Local .xml.gz -> gunzip -> edit -> gzip -> local .xml.gz. Returns the
+    # SHA-256 of dst_file and the result of edit.
+    out_hash = HashSink()
+    try:
+        with open(src_file, "rb") as fin, open(dst_file, "wb") as fout:
+            result = edit_gzip_stream(
+                fin, fout, edit, out_sinks=[out_hash], timings=timings
+            )
+    except Exception:
+        if os.path.exists(dst_file):
+            os.remove(dst_file)
+        raise
+    return out_hash.hexdigest(), result
+
+
+def upload_lrt(sftp, src_file, r_file, timings=None):
+    # Returns the (seconds, bytes) of the upload
+    start = time.perf_counter()
+    try:
+        with open(src_file, "rb") as fin, sftp.open(r_file, "wb") as fout:
+            # Writes are sent without waiting for the answer of the previous
+            # one; errors come back on close
+            fout.set_pipelined(True)
+            shutil.copyfileobj(fin, fout, TRANSFER_BUFFER)
+    except Exception:
+        remove_remote_file(sftp, r_file)
+        raise
+    result = (time.perf_counter() - start, os.path.getsize(src_file))
+    if timings is not None:
+        timings["upload"] = result
+    return result
+
+
+def render_routes(tab, records, domain):
+    # [(number, next)] for every InputRecord, built from the LRT_TABLES spec
+    spec = LRT_TABLES[tab]
+    columns = spec["columns"]
+    lookups = spec.get("lookups", {})
+    template = spec["template"]
+    check_records(records, [tab])
+    routes = []
+    for record in records:
+        fields = {name: getattr(record, field) for name, field in columns.items()}
+        fields["domain"] = domain
+        for field, (table, targets) in lookups.items():
+            values = table.get(fields[field])
+            if values is None:
+                raise ValueError(
+                    f"Unknown {field} {fields[field]!r} for number {fields['number']}"
+                )
+            fields.update(zip(targets, values))
+        routes.append((fields["number"], template.format_map(fields)))
+    return routes
+
+
+def operation_routes(tab, records, domain, operation=OPERATION):
+    # The routes of the operation: removing only needs the numbers
+    if operation == "remove":
+        return [(record.number, None) for record in records]
+    return render_routes(tab, records, domain)
+
+
+def routes_digest(routes, operation=OPERATION):
+    # SHA-256 of the rendered routes, so VSRs given the same rows share edits.
+    # Adds hash the routes alone, as before there were other operations.
+    digest = hashlib.sha256()
+    if operation != "add":
+        digest.update(f"{operation}\n".encode())
+    for number, next_text in routes:
+        digest.update(f"{number}\t{next_text}\n".encode())
+    return digest.hexdigest()
+
+
+def plan_digest(plan, duplicates=DUPLICATES, operation=OPERATION):
+    # Identifies the work of a run, so a resume only picks up the same work
+    digest = hashlib.sha256(duplicates.encode())
+    for vsr_name in sorted(plan):
+        for domain, tab in sorted(plan[vsr_name]):
+            routes = routes_digest(plan[vsr_name][(domain, tab)], operation)
+            digest.update(f"{vsr_name}\t{domain}\t{tab}\t{routes}\n".encode())
+    return digest.hexdigest()
+
+
+def generate_lrt(fin, fout, routes, logger_name, index, duplicates=DUPLICATES):
+    # Returns the routes the LRT has after the edit and the numbers of routes
+    # not added (already in the LRT)
+    added = set()
+
+    def selected():
+        for number, next_text in index.select(routes, duplicates, logger_name):
+            added.add(number)
+            yield number, next_text
 
-    with open(lrt_file, "wb") as f:
-        f.write(xml_data)
+    total, count = splice_routes(
+        fin, fout, selected(), users=None if index.complete else index.users
+    )
+    index.complete = True
 
+    logger_name.info(f"Total entries: {total}")
     logger_name.info(f"Entries added: {count}")
-    logger_name.info(f"New total entries: {len(root)}")
-
-
-def generate_lrt_B(lrt_file, csv_file, logger_name):
-    tree = etree.parse(lrt_file)
-    root = tree.getroot()
-    logger_name.info(f"Total entries: {len(root)}")
-    count = 0
-    for row in tqdm(csv_file, desc="Adding entries", leave=False):
-        number = row[0]
-        lst_carrier = CARRIERS.get(row[5])
-        tgrp, tcontext, fqdn = lst_carrier[0], lst_carrier[1], lst_carrier[2]
-        route_elem = etree.SubElement(root, "route")
-        user_elem = etree.SubElement(route_elem, "user")
-        next_elem = etree.SubElement(route_elem, "next")
-        user_elem.set("type", "E164")
-        next_elem.set("type", "regex")
-        user_elem.text = number
-        next_elem.text = f"!(^.*)$!sip:\\1;tgrp={tgrp};trunk-context={tcontext}@{fqdn}!"
-        count += 1
-        time.sleep(0.05)
-
-    etree.indent(tree)
-    xml_data = etree.tostring(
-        tree,
-        pretty_print=True,
-        xml_declaration=True,
-        encoding="UTF-8",
-        standalone=True,
+    logger_name.info(f"New total entries: {total + count}")
+    return total + count, [
+        number for number, next_text in routes if number not in added
+    ]
+
+
+def update_lrt(fin, fout, routes, logger_name, index, operation):
+    # Points the routes of the numbers to their new next (update) or drops
+    # them (remove) in one pass over the LRT. Numbers not in the LRT are
+    # reported and left out. Returns the routes the LRT has after the edit
+    # and the numbers left out.
+    if operation == "remove":
+        changes = {number: None for number, next_text in routes}
+    else:
+        changes = dict(routes)
+    total, count, found = rewrite_routes(
+        fin, fout, changes, users=None if index.complete else index.users
     )
+    if operation == "remove":
+        index.users.difference_update(found)
+    index.complete = True
+    for number in changes:
+        if number not in found:
+            logger_name.warning(f"Number {number} not in the LRT, skipped")
 
-    with open(lrt_file, "wb") as f:
-        f.write(xml_data)
+    logger_name.info(f"Total entries: {total}")
+    if operation == "remove":
+        logger_name.info(f"Entries removed: {total - count}")
+    else:
+        logger_name.info(f"Entries updated: {len(found)}")
+    logger_name.info(f"New total entries: {count}")
+    return count, [number for number in changes if number not in found]
 
-    logger_name.info(f"Entries added: {count}")
-    logger_name.info(f"New total entries: {len(root)}")
 
+def read_until_prompt(channel, prompt=None, timeout=REFRESH_TIMEOUT):
+    # Reads the shell output until it ends with the prompt (or with anything
+    # that looks like one when prompt is None). Returns (output, prompt).
+    output = ""
+    deadline = time.monotonic() + timeout
+    while True:
+        text = output.rstrip(" ")
+        if prompt is not None:
+            if text.endswith(prompt):
+                return output[: output.rfind(prompt)], prompt
+        else:
+            m = _PROMPT.search(text)
+            if m and not channel.recv_ready():
+                return output[: m.start(1)], m.group(1).strip()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"No prompt from the VSR after {timeout}s")
+        channel.settimeout(remaining)
+        try:
+            data = channel.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            raise EOFError("Shell closed by the VSR")
+        output += data.decode("ascii", errors="replace")
 
-def remove_file_by_extension(dir, exten):
-    for f in os.listdir(dir):
-        if f.endswith(exten):
-            os.remove(os.path.join(dir, f))
 
+def parse_refresh(lrt, output):
+    m = _ROUTES.search(output)
+    routes = int(m.group(1) or m.group(2)) if m else None
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    return {
+        "lrt": lrt,
+        "command": lines[0] if lines else "",
+        "response": " ".join(lines[1:]),
+        "routes": routes,
+        "ok": routes is not None and not _REFRESH_ERROR.search(output),
+    }
 
-def count_lines_csv(input_file):
-    lines = 0
-    for row in open(input_file):
-        lines += 1
-    return lines
 
+def refresh_lrt(channel, lrts, logger_name, expected=None, timeout=REFRESH_TIMEOUT):
+    # Sends one notify lrtd refresh per LRT on the same shell and waits for
+    # the prompt after each, so every response is paired with its command.
+    # Returns one result dict per LRT; expected maps LRT -> route count.
+    from tqdm import tqdm
 
-def refresh_lrt(host, lrts, logger_name):
-    myssh = create_ssh_connection(host)
-    channel = myssh.invoke_shell()
-    output = ""
+    expected = expected or {}
+    results = []
+    banner, prompt = read_until_prompt(channel, None, timeout)
     for lrt in tqdm(lrts, desc="Refreshing LRTs", leave=False):
         channel.send(f"notify lrtd refresh {lrt}" + "\n")
-        time.sleep(2)
-        resp = channel.recv(4096).decode("ascii")
-        output += resp
-    lines = output.split("\r\n")
-    command_list = [line for line in lines if re.search("notify", line)]
-    result_list = [line for line in lines if re.search("routes", line)]
-    for i in range(0, len(lrts)):
-        logger_name.info(f"{command_list[i]}: {result_list[i]}")
-    myssh.close()
-
-
-def edit_lrt_vsr(domain, input_file, vsrs, tables, logger_name):
-    for vsr_name in tqdm(vsrs, desc="Working in VSR(s)", colour="green"):
-        remove_file_by_extension(WORKING_PATH, ".gz")
-        logger_name.info(f"Working in {vsr_name}")
-        vsr_ip = VSRS.get(vsr_name)
-        lst_lrt_refresh = [x + f".{domain}" for x in tables]
-        lst_lrt = [x + f".{domain}.xml.gz" for x in tables]
-        fails = download_lrt(vsr_ip, WORKING_PATH, REMOTE_PATH, lst_lrt, logger_name)
+        output, prompt = read_until_prompt(channel, prompt, timeout)
+        result = parse_refresh(lrt, output)
+        result["expected"] = expected.get(lrt)
+        if result["expected"] is not None and result["routes"] != result["expected"]:
+            result["ok"] = False
+        logger_name.info(f"{result['command']}: {result['response']}")
+        if not result["ok"]:
+            logger_name.error(
+                f"Refresh of {lrt} failed: lrtd reported {result['routes']} "
+                f"routes, expected {result['expected']}"
+            )
+        results.append(result)
+    return results
+
+
+def edit_vsr(
+    vsr_name,
+    work,
+    logger_name,
+    sessions,
+    metrics,
+    duplicates=DUPLICATES,
+    edits=None,
+    journal=None,
+    operation=OPERATION,
+):
+    # work maps every (domain, table) to edit in this VSR to its rendered
+    # [(number, next)]. edits is shared by the VSRs worked at the same time,
+    # journal records the stages completed for a later resume.
+    own_edits = edits is None
+    if own_edits:
+        edits = SharedEdits()
+    if journal is None:
+        journal = RunJournal(plan_digest({vsr_name: work}, duplicates, operation))
+    try:
+        return _edit_vsr(
+            vsr_name,
+            work,
+            logger_name,
+            sessions,
+            metrics,
+            duplicates,
+            edits,
+            journal,
+            operation,
+        )
+    finally:
+        if own_edits:
+            edits.cleanup()
+
+
+def _edit_vsr(
+    vsr_name,
+    work,
+    logger_name,
+    sessions,
+    metrics,
+    duplicates,
+    edits,
+    journal,
+    operation,
+):
+    from tqdm import tqdm
+
+    vsr_logger = VsrLoggerAdapter(logger_name, {"vsr": vsr_name})
+    refreshed = journal.state(vsr_name)
+    if refreshed is not None and refreshed["stage"] == "refreshed":
+        vsr_logger.info(f"Work in {vsr_name} already finished by the interrupted run")
+        return [], {}
+    vsr_logger.info(f"Working in {vsr_name}")
+    vsr_ip = VSRS.get(vsr_name)
+    lrts = {key: f"{key[1]}.{key[0]}" for key in work}
+    lst_lrt = [lrt + ".xml.gz" for lrt in lrts.values()]
+    # Download, backup and upload all run over the same SSH transport
+    with metrics.stage("connect", vsr_name):
+        sftp = sessions.open_sftp(vsr_ip)
+    try:
+        with metrics.stage("stat", vsr_name):
+            stats = stat_lrt(sftp, REMOTE_PATH, lst_lrt, vsr_logger)
+        if len(stats) < len(lst_lrt):
+            vsr_logger.info(f"Work in {vsr_name} aborted")
+            return [
+                f"{len(lst_lrt) - len(stats)} LRT(s) not found in {REMOTE_PATH}"
+            ], {}
+        # Where the interrupted run of the same work left every table
+        resumed = {}
+        for domain, tab in work:
+            lrt = f"{tab}.{domain}.xml.gz"
+            state = journal.state(vsr_name, domain, tab)
+            tmp = None
+            if state is not None and state["stage"] == "uploaded":
+                tmp = stat_lrt(sftp, REMOTE_PATH, [lrt + ".tmp"], vsr_logger).get(
+                    lrt + ".tmp"
+                )
+            point, state = journal.resume_point(vsr_name, domain, tab, stats[lrt], tmp)
+            if point is not None:
+                vsr_logger.info(f"LRT {lrt} resumed after the stage {point}")
+                resumed[(domain, tab)] = (point, state)
+        indexes = {
+            (domain, tab): load_route_index(
+                vsr_name, domain, tab, stats[f"{tab}.{domain}.xml.gz"]
+            )
+            for domain, tab in work
+        }
+        if duplicates == "error" and operation == "add":
+            # Fail before touching anything when the cached index already knows
+            for key, routes in work.items():
+                if key in resumed:
+                    continue
+                found = find_duplicates(
+                    [number for number, next_text in routes], indexes[key]
+                )
+                if found:
+                    vsr_logger.info(f"Work in {vsr_name} aborted")
+                    return [
+                        f"{len(found)} number(s) already in {lrts[key]}: "
+                        + ", ".join(found[:10])
+                    ], {}
+        edited = []
+        expected = {}
+        # Numbers of the work left out of every table by the edit
+        dropped = {}
+        timings = {key: {} for key in work}
+
+        def upload(sftp, domain, tab, staged, r_tmp):
+            lrt = f"{tab}.{domain}.xml.gz"
+            seconds, nbytes = upload_lrt(sftp, staged, r_tmp, timings[(domain, tab)])
+            journal.record(
+                vsr_name,
+                domain,
+                tab,
+                "uploaded",
+                upload=file_attrs(sftp.stat(r_tmp)),
+            )
+            vsr_logger.info(
+                f"Successfully copied LRT {lrt} to {r_tmp}, "
+                f"{transfer_rate(seconds, nbytes)}"
+            )
+
+        def lrt_edit(routes, index):
+            if operation == "add":
+                return lambda fin, fout: generate_lrt(
+                    fin, fout, routes, vsr_logger, index, duplicates
+                )
+            return lambda fin, fout: update_lrt(
+                fin, fout, routes, vsr_logger, index, operation
+            )
+
+        def stream(sftp, domain, tab, routes):
+            # No other VSR can share this edit, so the LRT goes from the VSR
+            # through the edit and back without being read back from disk
+            lrt = f"{tab}.{domain}.xml.gz"
+            r_tmp = f"{REMOTE_PATH}/{lrt}.tmp"
+            part = os.path.join(journal.path, f"{tab}.{domain}.{vsr_name}.part")
+            meta, sha256, (count, dropped[(domain, tab)]) = stream_edit_lrt(
+                sftp,
+                REMOTE_PATH,
+                lrt,
+                stats[lrt],
+                (vsr_name, domain, tab),
+                part,
+                lrt_edit(routes, indexes[(domain, tab)]),
+                vsr_logger,
+                timings[(domain, tab)],
+            )
+            staged = journal.keep(part, sha256)
+            os.remove(part)
+            expected[f"{tab}.{domain}"] = count
+            journal.record(
+                vsr_name,
+                domain,
+                tab,
+                "downloaded",
+                source=file_attrs(stats[lrt]),
+                source_sha256=meta["sha256"],
+            )
+            store_backup(
+                vsr_name,
+                domain,
+                tab,
+                mirror_file(vsr_name, domain, tab),
+                meta["sha256"],
+            )
+            vsr_logger.info(
+                f"Backup completed from {REMOTE_PATH}/{lrt} to "
+                f"{blob_file(meta['sha256'])}"
+            )
+            journal.record(
+                vsr_name,
+                domain,
+                tab,
+                "edited",
+                sha256=sha256,
+                expected=count,
+                dropped=dropped[(domain, tab)],
+            )
+            journal.record(
+                vsr_name,
+                domain,
+                tab,
+                "uploaded",
+                upload=file_attrs(sftp.stat(r_tmp)),
+            )
+            edited.append((domain, tab, r_tmp, sha256, staged))
+            vsr_logger.info(f"Finish the work in table {tab}.{domain}.xml")
+
+        try:
+            # Tables are transferred on parallel SFTP channels. The tables
+            # another VSR of the plan gets the same routes for are downloaded
+            # to the mirror and edited once for all of them, and each upload
+            # starts as soon as its table is edited; every other table is
+            # streamed from the VSR through the edit back to it.
+            digests = {
+                key: routes_digest(routes, operation) for key, routes in work.items()
+            }
+            direct = {
+                key
+                for key in work
+                if key not in resumed and not edits.is_shared(*key, digests[key])
+            }
+            with TransferPool(sessions, vsr_ip) as transfers:
+                downloads = {
+                    (domain, tab): transfers.submit(
+                        sync_lrt,
+                        REMOTE_PATH,
+                        f"{tab}.{domain}.xml.gz",
+                        stats[f"{tab}.{domain}.xml.gz"],
+                        (vsr_name, domain, tab),
+                        vsr_logger,
+                        timings[(domain, tab)],
+                    )
+                    for domain, tab in work
+                    if (domain, tab) not in resumed and (domain, tab) not in direct
+                }
+                pending = [
+                    transfers.submit(stream, domain, tab, work[(domain, tab)])
+                    for domain, tab in direct
+                ]
+                for (domain, tab), routes in tqdm(
+                    work.items(), desc=f"Working in tables ({vsr_name})", leave=False
+                ):
+                    if (domain, tab) in direct:
+                        continue
+                    vsr_logger.info(f"Start the work in table {tab}.{domain}.xml")
+                    lrt = f"{tab}.{domain}.xml.gz"
+                    r_tmp = f"{REMOTE_PATH}/{lrt}.tmp"
+                    point, state = resumed.get((domain, tab), (None, None))
+                    if point is not None:
+                        expected[f"{tab}.{domain}"] = state["expected"]
+                        dropped[(domain, tab)] = state.get("dropped", [])
+                        # The edit was not redone, so the route index is unknown
+                        indexes[(domain, tab)] = None
+                        staged = journal.staged_file(state["sha256"])
+                        if point == "renamed":
+                            vsr_logger.info(f"LRT {lrt} already uploaded, skipped")
+                            continue
+                        if point == "edited":
+                            pending.append(
+                                transfers.submit(upload, domain, tab, staged, r_tmp)
+                            )
+                        edited.append((domain, tab, r_tmp, state["sha256"], staged))
+                        continue
+                    meta = downloads[(domain, tab)].result()
+                    mirror = mirror_file(vsr_name, domain, tab)
+                    journal.record(
+                        vsr_name,
+                        domain,
+                        tab,
+                        "downloaded",
+                        source=file_attrs(stats[lrt]),
+                        source_sha256=meta["sha256"],
+                    )
+                    store_backup(vsr_name, domain, tab, mirror, meta["sha256"])
+                    vsr_logger.info(
+                        f"Backup completed from {REMOTE_PATH}/{lrt} to "
+                        f"{blob_file(meta['sha256'])}"
+                    )
+                    # VSRs holding the same LRT and given the same routes share
+                    # one edit and upload the same .xml.gz
+                    key = (domain, tab, meta["sha256"], digests[(domain, tab)])
+                    staged = edits.staging_file(*key)
+                    index = indexes[(domain, tab)]
+                    edit = lrt_edit(routes, index)
+                    owner, (sha256, result, index) = edits.get(
+                        key,
+                        lambda: edit_lrt_file(
+                            mirror, staged, edit, timings[(domain, tab)]
+                        )
+                        + (index,),
+                    )
+                    expected[f"{tab}.{domain}"], dropped[(domain, tab)] = result
+                    if not owner:
+                        vsr_logger.info(
+                            f"LRT {lrt} identical to one already edited, "
+                            "reusing the edit"
+                        )
+                    indexes[(domain, tab)] = index
+                    staged = journal.keep(staged, sha256)
+                    journal.record(
+                        vsr_name,
+                        domain,
+                        tab,
+                        "edited",
+                        sha256=sha256,
+                        expected=expected[f"{tab}.{domain}"],
+                        dropped=dropped[(domain, tab)],
+                    )
+                    edited.append((domain, tab, r_tmp, sha256, staged))
+                    pending.append(transfers.submit(upload, domain, tab, staged, r_tmp))
+                    vsr_logger.info(f"Finish the work in table {tab}.{domain}.xml")
+                for future in pending:
+                    future.result()
+        except Exception:
+            # The transfers are over by now. A resume uploads them again from
+            # the journal, without the edit.
+            for domain, tab, r_tmp, sha256, staged in edited:
+                remove_remote_file(sftp, r_tmp)
+            raise
+        for (domain, tab), stages in timings.items():
+            for stage, (seconds, nbytes) in stages.items():
+                if stage == "read":
+                    stage = "mirror"
+                elif stage == "write":
+                    stage = "staging"
+                rows = len(work[(domain, tab)]) if stage == "edit" else None
+                metrics.add(
+                    stage, seconds, vsr_name, f"{tab}.{domain}.xml.gz", nbytes, rows
+                )
+        # Only swap the live tables once every table was uploaded
+        for domain, tab, r_tmp, sha256, staged in edited:
+            r_file = r_tmp[: -len(".tmp")]
+            with metrics.stage("rename", vsr_name, os.path.basename(r_file)):
+                replace_remote_file(sftp, r_tmp, r_file)
+            vsr_logger.info(f"Successfully uploaded LRT: {os.path.basename(r_file)}")
+            attrs = sftp.stat(r_file)
+            if indexes[(domain, tab)] is not None:
+                save_route_index(
+                    vsr_name, domain, tab, indexes[(domain, tab)], attrs, sha256
+                )
+            # What was just uploaded is the known state of the LRT for next runs
+            mirror = mirror_file(vsr_name, domain, tab)
+            link_or_copy(staged, mirror + ".new")
+            save_mirror(vsr_name, domain, tab, mirror + ".new", attrs, sha256)
+            journal.record(vsr_name, domain, tab, "renamed")
+    finally:
+        sftp.close()
+    lst_lrt_refresh = list(lrts.values())
+    with metrics.stage("refresh", vsr_name, rows=len(lst_lrt_refresh)):
+        channel = sessions.open_shell(vsr_ip)
+        try:
+            results = refresh_lrt(channel, lst_lrt_refresh, vsr_logger, expected)
+        finally:
+            channel.close()
+    vsr_logger.info(f"Finish the work in {vsr_name}")
+    errors = [
+        f"Refresh of {r['lrt']} failed: {r['response'] or 'no response'}"
+        for r in results
+        if not r["ok"]
+    ]
+    if not errors:
+        journal.record(vsr_name, None, None, "refreshed")
+    # What the LRTs of this VSR got, for the history
+    written = {}
+    for key, routes in work.items():
+        left_out = set(dropped.get(key, ()))
+        written[key] = [route for route in routes if route[0] not in left_out]
+    return errors, written
+
+
+def edit_lrt_plan(
+    plan,
+    logger_name,
+    max_workers=MAX_WORKERS,
+    sessions=None,
+    duplicates=DUPLICATES,
+    metrics=None,
+    resume=False,
+    history=None,
+    operation=OPERATION,
+    written=None,
+):
+    # plan maps every VSR to its work, {(domain, table): [(number, next)]}.
+    # Returns {vsr_name: [errors]} only for the VSRs that failed. resume
+    # continues the interrupted run of the same plan, if any. The routes the
+    # VSRs that succeeded actually got, {vsr_name: {(domain, table): routes}},
+    # go to history and are filled in written when given.
+    from functions_socks import SessionManager
+    from tqdm import tqdm
+
+    fails = {}
+    if written is None:
+        written = {}
+    if metrics is None:
+        metrics = TaskMetrics()
+    evicted = evict_mirror()
+    if evicted:
+        logger_name.info(f"Evicted {evicted} stale LRT(s) from the local mirror")
+    backups, blobs = prune_backups()
+    if backups:
+        logger_name.info(f"Pruned {backups} old backup(s), {blobs} blob(s) removed")
+    journals = prune_journals()
+    if journals:
+        logger_name.info(f"Removed {journals} abandoned run journal(s)")
+    journal = RunJournal(plan_digest(plan, duplicates, operation), resume)
+    if journal.resumed:
+        logger_name.info(f"Resuming the interrupted run from {journal.file}")
+    elif resume:
+        logger_name.info("No interrupted run of the same work, starting from scratch")
+    own_sessions = sessions is None
+    if own_sessions:
+        sessions = SessionManager()
+    # Only the tables more than one VSR gets the same routes for can share an
+    # edit; the others are streamed straight back to their VSR
+    shared = Counter(
+        (domain, tab, routes_digest(routes, operation))
+        for work in plan.values()
+        for (domain, tab), routes in work.items()
+    )
+    edits = SharedEdits(key for key, count in shared.items() if count > 1)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {
+                executor.submit(
+                    edit_vsr,
+                    vsr_name,
+                    work,
+                    logger_name,
+                    sessions,
+                    metrics,
+                    duplicates,
+                    edits,
+                    journal,
+                    operation,
+                ): vsr_name
+                for vsr_name, work in plan.items()
+            }
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                desc="Working in VSR(s)",
+                colour="green",
+            ):
+                vsr_name = futures[future]
+                routes = {}
+                try:
+                    errors, routes = future.result()
+                except DuplicateRouteError as e:
+                    logger_name.error(f"Work in {vsr_name} aborted: {e}")
+                    errors = [str(e)]
+                except Exception as e:
+                    logger_name.exception(f"Work in {vsr_name} aborted: {e}")
+                    errors = [f"{type(e).__name__}: {e}"]
+                if errors:
+                    fails[vsr_name] = errors
+                else:
+                    written[vsr_name] = routes
+        journal.close(done=not fails)
+        if history is not None:
+            history.add_plan(written, operation)
         if fails:
-            logger_name.info(f"Work in {vsr_name} aborted")
-            continue
-        else:
-            for tab in tqdm(tables, desc="Working in tables", leave=False):
-                logger_name.info(f"Start the work in table {tab}.{domain}.xml")
-                lrt = os.path.join(WORKING_PATH, f"{tab}.{domain}.xml.gz")
-                lrt_bk = os.path.join(
-                    BACKUP_PATH,
-                    f"{tab}.{domain}-{vsr_name}-{datetime.now().strftime('%d%m%Y_%H%M%S')}.xml.gz",
+            logger_name.info(f"Run journal kept in {journal.file} for --resume")
+    finally:
+        edits.cleanup()
+        if own_sessions:
+            sessions.close_all()
+    return fails
+
+
+def edit_lrt_vsr(
+    domain,
+    records,
+    vsrs,
+    tables,
+    logger_name,
+    max_workers=MAX_WORKERS,
+    sessions=None,
+    duplicates=DUPLICATES,
+    metrics=None,
+    resume=False,
+    history=None,
+    operation=OPERATION,
+):
+    # Returns {vsr_name: [errors]} only for the VSRs that failed
+    if metrics is None:
+        metrics = TaskMetrics()
+    # The routes only depend on the input, so they are rendered once for all VSRs
+    with metrics.stage("render", rows=len(records) * len(tables)):
+        work = {
+            (domain, tab): operation_routes(tab, records, domain, operation)
+            for tab in tables
+        }
+    plan = {vsr_name: work for vsr_name in vsrs}
+    return edit_lrt_plan(
+        plan,
+        logger_name,
+        max_workers,
+        sessions,
+        duplicates,
+        metrics,
+        resume,
+        history,
+        operation,
+    )
+
+
+def rollback_vsr(vsr_name, targets, logger_name, sessions):
+    # targets maps every (domain, table) to the backup record to restore. The
+    # backups are pushed as they are, without going through the edit. The
+    # LRTs replaced are backed up first, so the rollback can be undone too.
+    vsr_logger = VsrLoggerAdapter(logger_name, {"vsr": vsr_name})
+    vsr_logger.info(f"Rolling back {vsr_name}")
+    vsr_ip = VSRS.get(vsr_name)
+    sftp = sessions.open_sftp(vsr_ip)
+    uploaded = []
+
+    def backup(sftp, domain, tab):
+        lrt = f"{tab}.{domain}.xml.gz"
+        try:
+            attrs = sftp.stat(f"{REMOTE_PATH}/{lrt}")
+        except FileNotFoundError:
+            return
+        meta = sync_lrt(
+            sftp, REMOTE_PATH, lrt, attrs, (vsr_name, domain, tab), vsr_logger
+        )
+        store_backup(
+            vsr_name, domain, tab, mirror_file(vsr_name, domain, tab), meta["sha256"]
+        )
+        vsr_logger.info(
+            f"Backup completed from {REMOTE_PATH}/{lrt} to "
+            f"{blob_file(meta['sha256'])}"
+        )
+
+    try:
+        try:
+            with TransferPool(sessions, vsr_ip) as transfers:
+                uploads = []
+                for (domain, tab), record in targets.items():
+                    uploads.append(transfers.submit(backup, domain, tab))
+                    r_tmp = f"{REMOTE_PATH}/{tab}.{domain}.xml.gz.tmp"
+                    uploads.append(
+                        transfers.submit(upload_lrt, blob_file(record["sha256"]), r_tmp)
+                    )
+                    uploaded.append((domain, tab, r_tmp, record["sha256"]))
+                for future in uploads:
+                    future.result()
+        except Exception:
+            for domain, tab, r_tmp, sha256 in uploaded:
+                remove_remote_file(sftp, r_tmp)
+            raise
+        for domain, tab, r_tmp, sha256 in uploaded:
+            r_file = r_tmp[: -len(".tmp")]
+            replace_remote_file(sftp, r_tmp, r_file)
+            vsr_logger.info(
+                f"Restored LRT {os.path.basename(r_file)} from {blob_file(sha256)}"
+            )
+            attrs = sftp.stat(r_file)
+            mirror = mirror_file(vsr_name, domain, tab)
+            os.makedirs(os.path.dirname(mirror), exist_ok=True)
+            link_or_copy(blob_file(sha256), mirror + ".new")
+            save_mirror(vsr_name, domain, tab, mirror + ".new", attrs, sha256)
+    finally:
+        sftp.close()
+    channel = sessions.open_shell(vsr_ip)
+    try:
+        results = refresh_lrt(
+            channel, [f"{tab}.{domain}" for domain, tab in targets], vsr_logger
+        )
+    finally:
+        channel.close()
+    vsr_logger.info(f"Finish the rollback in {vsr_name}")
+    return [
+        f"Refresh of {r['lrt']} failed: {r['response'] or 'no response'}"
+        for r in results
+        if not r["ok"]
+    ]
+
+
+def find_rollback_targets(domain, tables, vsrs, before=None, sha256=None):
+    # Returns ({vsr_name: {(domain, table): record}}, {vsr_name: [errors]})
+    # with the latest backup at or before the given time (or with the given
+    # hash) of every LRT
+    plan = {}
+    fails = {}
+    for vsr_name in vsrs:
+        for tab in tables:
+            record = find_backup(vsr_name, domain, tab, before, sha256)
+            if record is None:
+                fails.setdefault(vsr_name, []).append(
+                    f"No backup of {tab}.{domain} found"
                 )
-                shutil.copyfile(lrt, lrt_bk)
-                logger_name.info(f"Backup completed from {lrt} to {lrt_bk}")
-                lrt_1 = gunzip_lrt(lrt, logger_name)
-                if tab == "R":
-                    generate_lrt_R(lrt_1, input_file, domain, logger_name)
-                elif tab == "S":
-                    generate_lrt_S(lrt_1, input_file, logger_name)
-                elif tab == "B":
-                    generate_lrt_B(lrt_1, input_file, logger_name)
-                lrt_2 = gzip_lrt(lrt_1, logger_name)
-                logger_name.info(f"Finish the work in table {tab}.{domain}.xml")
-            upload_lrt(vsr_ip, WORKING_PATH, REMOTE_PATH, lst_lrt, logger_name)
-            refresh_lrt(vsr_ip, lst_lrt_refresh, logger_name)
-        logger_name.info(f"Finish the work in {vsr_name}")
+            else:
+                plan.setdefault(vsr_name, {})[(domain, tab)] = record
+    for vsr_name in fails:
+        plan.pop(vsr_name, None)
+    return plan, fails
+
+
+def rollback_lrt_vsr(plan, logger_name, max_workers=MAX_WORKERS, sessions=None):
+    # plan as returned by find_rollback_targets. Returns {vsr_name: [errors]}
+    # only for the VSRs that failed
+    from functions_socks import SessionManager
+    from tqdm import tqdm
+
+    fails = {}
+    own_sessions = sessions is None
+    if own_sessions:
+        sessions = SessionManager()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {
+                executor.submit(
+                    rollback_vsr, vsr_name, targets, logger_name, sessions
+                ): vsr_name
+                for vsr_name, targets in plan.items()
+            }
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                desc="Rolling back VSR(s)",
+                colour="green",
+            ):
+                vsr_name = futures[future]
+                try:
+                    errors = future.result()
+                except Exception as e:
+                    logger_name.exception(f"Rollback in {vsr_name} aborted: {e}")
+                    errors = [f"{type(e).__name__}: {e}"]
+                if errors:
+                    fails[vsr_name] = errors
+    finally:
+        if own_sessions:
+            sessions.close_all()
     return fails
 
 
-def save_output_file(input_file, logger_name):
+def save_output_file(input_file, logger_name, tag=None):
     current_date_time = datetime.now().strftime("%d%m%Y_%H%M%S")
+    if tag:
+        current_date_time = f"{tag}_{current_date_time}"
     file_record = (
         os.path.basename(input_file).rstrip(".csv") + f"_{current_date_time}" + ".csv"
     )
@@ -287,159 +1234,275 @@ def save_output_file(input_file, logger_name):
     logger_name.info(f"History file generated: {file_record}")
 
 
+def country_prefixes():
+    # Every country calling code libphonenumber knows. Calling codes are
+    # prefix-free, so the first 1-3 digits of a number match at most one.
+    global _COUNTRY_PREFIXES
+    if _COUNTRY_PREFIXES is None:
+        import phonenumbers
+
+        _COUNTRY_PREFIXES = frozenset(
+            str(cc) for cc in phonenumbers.COUNTRY_CODE_TO_REGION_CODE
+        )
+    return _COUNTRY_PREFIXES
+
+
+def resolve_country_code(phone):
+    # Country code of plain E.164 digits whose national part fits the
+    # lengths above, from the prefix table. None for anything else, which
+    # only phonenumbers.parse can normalize or reject.
+    if not (phone.isascii() and phone.isdigit()):
+        return None
+    prefixes = country_prefixes()
+    for length in range(1, MAX_LENGTH_CC + 1):
+        cc = phone[:length]
+        if cc in prefixes:
+            if MIN_LENGTH_NSN <= len(phone) - length <= MAX_LENGTH_NSN:
+                return cc
+            return None
+    return None
+
+
+def parse_country_code(phone):
+    import phonenumbers
+
+    return str(phonenumbers.parse(f"+{phone}", None).country_code)
+
+
 def get_data_aramis(phone):
-    x = phonenumbers.parse(f"+{phone}", None)
-    cc = str(x.country_code)
+    cc = resolve_country_code(phone)
+    if cc is None:
+        cc = parse_country_code(phone)
     result = DATA_ARAMIS.get(cc)
     return result, cc
 
 
-def create_file_DDI(input_file, enterpise, logger_name):
-    total_lines = count_lines_csv(input_file)
-    with open(DDI_FILE, "w", newline="") as final:
-        with open(input_file, newline="") as original:
-            reader = csv.reader(
-                original,
-                delimiter="\t",
-            )
-            writer = csv.writer(final, quoting=csv.QUOTE_ALL, delimiter=",")
-            writer.writerow(
-                [
-                    "Source ID",
-                    "Source",
-                    "ISO Code",
-                    "Country",
-                    "Digits",
-                    "Last Modification",
-                    "Source Type",
-                    "Mask",
-                    "Mask Active",
-                    "CPC",
-                    "NumA",
-                    "Group Country NumA",
-                    "Business Unit",
-                    "MNC",
-                    "Rate",
-                    "Billing Increments",
-                ]
-            )
-            counter = 0
-            with tqdm(
-                desc="Generating DDI file", total=total_lines, colour="green"
-            ) as pbar:
-                for rows in reader:
-                    data, cc = get_data_aramis(rows[0])
-                    writer.writerow(
-                        [
-                            data[0],
-                            "DDI-Bidirectional",
-                            cc,
-                            data[1],
-                            rows[0],
-                            "",
-                            "Fixed",
-                            rows[0],
-                            "1",
-                            "0",
-                            "",
-                            "",
-                            "",
-                            enterpise,
-                            "0,0",
-                            "1/1",
-                        ]
-                    )
-                    counter += 1
-                    pbar.update(1)
-                    time.sleep(0.1)
-    logger_name.info(f"Successfully generated: {DDI_FILE}")
-    logger_name.info(f"The {DDI_FILE} has {counter} entries")
-
-
-def create_file_SN(input_file, enterpise, logger_name):
-    total_lines = count_lines_csv(input_file)
-    with open(SN_FILE, "w", newline="") as final:
-        with open(input_file, newline="") as original:
-            reader = csv.reader(
-                original,
-                delimiter="\t",
+def preflight(records, tables=(), exports=()):
+    # Validates the whole input for the selected LRTs and ARAMIS exports in a
+    # single pass, before any connection is opened: column counts, number
+    # format, lookup keys (CARRIERS), DATA_ARAMIS coverage and numbers
+    # repeated in the file. Returns every problem found, [] when there is none.
+    needed = needed_fields(tables, exports)
+    lookups = {
+        field: table
+        for tab in tables
+        for field, (table, targets) in LRT_TABLES[tab].get("lookups", {}).items()
+    }
+    digits = [
+        (field, width)
+        for kind in exports
+        for field, source_type, width in ARAMIS_EXPORTS[kind]["digits"]
+        if field != "number"
+    ]
+    seen = {}
+    problems = []
+    for record in records:
+        where = f"Line {record.line}"
+        number = record.number
+        if not _E164.fullmatch(number):
+            problems.append(f"{where}: {number!r} is not a valid E.164 number")
+        elif exports:
+            # The exports resolve the country code the same way
+            cc = resolve_country_code(number)
+            if cc is None:
+                from phonenumbers import NumberParseException
+
+                try:
+                    cc = parse_country_code(number)
+                except NumberParseException as e:
+                    problems.append(f"{where}: {number} is not a valid number: {e}")
+            if cc is not None and DATA_ARAMIS.get(cc) is None:
+                problems.append(
+                    f"{where}: country code {cc} of {number} not in DATA_ARAMIS"
+                )
+        first = seen.setdefault(number, record.line)
+        if first != record.line:
+            problems.append(f"{where}: {number} repeated, first on line {first}")
+        missing = [field for field, width in needed.items() if record.width < width]
+        if missing:
+            problems.append(
+                f"{where}: {record.width} column(s), no {', '.join(missing)}"
             )
-            writer = csv.writer(final, quoting=csv.QUOTE_ALL, delimiter=",")
-            writer.writerow(
-                [
-                    "Source ID",
-                    "Source",
-                    "ISO Code",
-                    "Country",
-                    "Digits",
-                    "Last Modification",
-                    "Source Type",
-                    "Mask",
-                    "Mask Active",
-                    "CPC",
-                    "NumA",
-                    "Group Country NumA",
-                    "Business Unit",
-                    "MNC",
-                    "Rate",
-                    "Billing Increments",
-                ]
+        for field, table in lookups.items():
+            value = getattr(record, field)
+            if value is not None and value not in table:
+                problems.append(f"{where}: unknown {field} {value!r}")
+        for field, width in digits:
+            value = getattr(record, field)
+            if value is None or (width is not None and record.width != width):
+                continue
+            if not value.isdigit():
+                problems.append(f"{where}: {field} digits {value!r} are not valid")
+    return problems
+
+
+def _counted(records, sizes):
+    for record in records:
+        sizes["rows"] += 1
+        yield record
+
+
+def preflight_input(records, tables, exports, logger_name, metrics=None):
+    # Runs the preflight and logs its full report. Returns {"input file":
+    # problems} when the task must not go on, {} when it can.
+    if metrics is None:
+        metrics = TaskMetrics()
+    with metrics.stage("preflight", rows=0) as sizes:
+        # records may be a stream (task 2), so they are counted on the way
+        problems = preflight(_counted(records, sizes), tables, exports)
+    if not problems:
+        logger_name.info(f"Preflight passed for {sizes['rows']} input rows")
+        return {}
+    logger_name.error(
+        f"Preflight found {len(problems)} problem(s) in the input, "
+        "nothing was sent to the VSRs:\n" + "\n".join(problems)
+    )
+    return {"input file": problems}
+
+
+def read_lines_with_progress(input_file, pbar):
+    # Text lines of input_file, advancing pbar by the bytes read
+    encoding = locale.getpreferredencoding(False)
+    with open(input_file, "rb") as f:
+        for line in f:
+            pbar.update(len(line))
+            yield line.decode(encoding)
+
+
+def aramis_row(data, source, cc, digits, source_type, mask, enterpise):
+    return [
+        data[0],
+        source,
+        cc,
+        data[1],
+        digits,
+        "",
+        source_type,
+        mask,
+        "1",
+        "0",
+        "",
+        "",
+        "",
+        enterpise,
+        "0,0",
+        "1/1",
+    ]
+
+
+def create_aramis_files(
+    input_file,
+    enterpise,
+    logger_name,
+    kinds=("DDI", "SN"),
+    metrics=None,
+    records=None,
+    history=None,
+):
+    # Writes every file in kinds on the same pass over the records, streamed
+    # from input_file unless they were already read. history gets the
+    # numbers exported.
+    if metrics is None:
+        metrics = TaskMetrics()
+    nbytes = os.path.getsize(input_file) if records is None else None
+    with metrics.stage("export_" + "_".join(kinds), nbytes=nbytes) as sizes:
+        numbers = [] if history is not None else None
+        counters = _write_aramis_files(input_file, enterpise, kinds, records, numbers)
+        sizes["rows"] = max(counters.values(), default=0)
+    if history is not None:
+        for kind in kinds:
+            history.add_export(kind, numbers, enterpise)
+    for kind in kinds:
+        spec = ARAMIS_EXPORTS[kind]
+        logger_name.info(f"Successfully generated: {spec['file']}")
+        logger_name.info(f"The {spec['file']} has {counters[kind]} entries")
+    return counters
+
+
+def _write_aramis_files(input_file, enterpise, kinds, records=None, numbers=None):
+    from tqdm import tqdm
+
+    exports = {kind: ARAMIS_EXPORTS[kind] for kind in kinds}
+    counters = dict.fromkeys(exports, 0)
+    finals = {
+        kind: open(spec["file"], "w", newline="") for kind, spec in exports.items()
+    }
+    try:
+        writers = {
+            kind: csv.writer(final, quoting=csv.QUOTE_ALL, delimiter=",")
+            for kind, final in finals.items()
+        }
+        for writer in writers.values():
+            writer.writerow(ARAMIS_HEADER)
+        batches = {kind: [] for kind in exports}
+        desc = " & ".join(spec["desc"] for spec in exports.values())
+        if records is None:
+            progress = tqdm(
+                desc=desc,
+                total=os.path.getsize(input_file),
+                unit="B",
+                unit_scale=True,
+                colour="green",
             )
-            counter = 0
-            with tqdm(
-                desc="Generating Special Number file", total=total_lines, colour="green"
-            ) as pbar:
-                for rows in reader:
-                    data, cc = get_data_aramis(rows[0])
-                    writer.writerow(
-                        [
-                            data[0],
-                            "Special-Numbers",
-                            cc,
-                            data[1],
-                            rows[3],
-                            "",
-                            "Fixed",
-                            rows[0],
-                            "1",
-                            "0",
-                            "",
-                            "",
-                            "",
-                            enterpise,
-                            "0,0",
-                            "1/1",
-                        ]
-                    )
-                    if len(rows) == 5:
-                        writer.writerow(
-                            [
-                                data[0],
-                                "Special-Numbers",
-                                cc,
-                                data[1],
-                                rows[4],
-                                "",
-                                "Mobile",
-                                rows[0],
-                                "1",
-                                "0",
-                                "",
-                                "",
-                                "",
-                                enterpise,
-                                "0,0",
-                                "1/1",
-                            ]
-                        )
-                    counter += 1
+        else:
+            progress = tqdm(desc=desc, total=len(records), colour="green")
+        with progress as pbar:
+            if records is None:
+                source = parse_records(read_lines_with_progress(input_file, pbar))
+            else:
+                source = records
+            for record in source:
+                data, cc = get_data_aramis(record.number)
+                if numbers is not None:
+                    numbers.append(record.number)
+                for kind, spec in exports.items():
+                    batch = batches[kind]
+                    for field, source_type, width in spec["digits"]:
+                        if width is None or record.width == width:
+                            batch.append(
+                                aramis_row(
+                                    data,
+                                    spec["source"],
+                                    cc,
+                                    getattr(record, field),
+                                    source_type,
+                                    record.number,
+                                    enterpise,
+                                )
+                            )
+                    counters[kind] += 1
+                    if len(batch) >= BATCH_SIZE:
+                        writers[kind].writerows(batch)
+                        batch.clear()
+                if records is not None:
                     pbar.update(1)
-                    time.sleep(0.1)
-    logger_name.info(f"Successfully generated: {SN_FILE}")
-    logger_name.info(f"The {SN_FILE} has {counter} entries")
+            for kind, batch in batches.items():
+                writers[kind].writerows(batch)
+    finally:
+        for final in finals.values():
+            final.close()
+    return counters
+
+
+def create_file_DDI(
+    input_file, enterpise, logger_name, metrics=None, records=None, history=None
+):
+    create_aramis_files(
+        input_file, enterpise, logger_name, ["DDI"], metrics, records, history
+    )
+
+
+def create_file_SN(
+    input_file, enterpise, logger_name, metrics=None, records=None, history=None
+):
+    create_aramis_files(
+        input_file, enterpise, logger_name, ["SN"], metrics, records, history
+    )
 
 
 def print_menu():
+    from pyfiglet import Figlet
+
     f = Figlet(font="slant")
     print(f.renderText("Daily Tasks"))
     print(23 * "-", " MENU ", 23 * "-")
@@ -469,10 +1532,10 @@ def input_values_option1():
 
     while True:
         tables = input("Ingress the name of the LRTs: ").upper().split()
-        if all(item in ["R", "S", "B"] for item in tables):
+        if all(item in LRT_TABLES for item in tables):
             break
         else:
-            print("Enter a valid value (R, S or B)")
+            print(f"Enter a valid value ({', '.join(LRT_TABLES)})")
             continue
 
     while True:
@@ -521,4 +1584,4 @@ def input_values_option4():
             print("Enter a valid VSR hostname")
             continue
 
-    return customer, domain, vsrs
\ No newline at end of file
+    return customer, domain, vsrs
@@ -0,0 +1,14 @@
+import os, shutil, threading
+
+
+def link_or_copy(src, dst):
+    # Puts src at dst in one atomic step, as a hard link when both are on the
+    # same filesystem and as a copy otherwise. The temporary name is unique to
+    # the thread, so threads racing for the same dst do not collide.
+    tmp = f"{dst}.{threading.get_ident()}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    return dst
@@ -0,0 +1,254 @@
+import os, queue, struct, threading, zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Block-parallel gzip in the style of pigz/BGZF. The writer cuts the stream in
+# blocks, deflates them on a thread pool and writes them as independent gzip
+# members, which gzip, zcat and the VSR read as one stream. Every member
+# carries its own size in an "LR" extra subfield, so the reader can split the
+# stream without inflating it and inflate the members in parallel too.
+
+# Threads used to deflate/inflate the members
+GZIP_THREADS = os.cpu_count() or 1
+# Uncompressed bytes per gzip member
+GZIP_BLOCK_SIZE = 1024 * 1024
+# Compressed bytes read at a time from the source stream
+READ_SIZE = 1024 * 1024
+
+_MAGIC = b"\x1f\x8b\x08"
+_FEXTRA = 0x04
+_SUBFIELD = b"LR"
+# Fixed header, XLEN, "LR" subfield (SI1, SI2, LEN, member size)
+_HEADER_SIZE = 10 + 2 + 8
+_TRAILER_SIZE = 8
+
+
+def compress_member(data, level):
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = deflate.compress(data) + deflate.flush()
+    # XFL 2 = maximum compression, 4 = fastest; MTIME 0 keeps the output
+    # identical for identical input; OS 255 = unknown
+    xfl = 2 if level == 9 else 4 if level == 1 else 0
+    size = _HEADER_SIZE + len(body) + _TRAILER_SIZE
+    return b"".join(
+        [
+            _MAGIC,
+            struct.pack("<BIBB", _FEXTRA, 0, xfl, 255),
+            struct.pack("<H2sHI", 8, _SUBFIELD, 4, size),
+            body,
+            struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF),
+        ]
+    )
+
+
+def member_size(header):
+    # Size of the member starting at header when it was written by
+    # compress_member, None for any other gzip member (or not enough bytes)
+    if len(header) < 12 or header[:3] != _MAGIC or not header[3] & _FEXTRA:
+        return None
+    (xlen,) = struct.unpack_from("<H", header, 10)
+    extra = header[12 : 12 + xlen]
+    if len(extra) < xlen:
+        return None
+    pos = 0
+    while pos + 4 <= len(extra):
+        si, slen = struct.unpack_from("<2sH", extra, pos)
+        if si == _SUBFIELD and slen == 4 and pos + 8 <= len(extra):
+            return struct.unpack_from("<I", extra, pos + 4)[0]
+        pos += 4 + slen
+    return None
+
+
+class ParallelGzipWriter:
+    # File-like writer: what is written to it reaches fout gzip compressed,
+    # one member per GZIP_BLOCK_SIZE, in order
+    def __init__(self, fout, level=9, threads=GZIP_THREADS, block_size=GZIP_BLOCK_SIZE):
+        self.fout = fout
+        self.level = level
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._members = 0
+        self._max_pending = 2 * max(1, threads)
+        self._executor = ThreadPoolExecutor(threads) if threads > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[: self.block_size])
+            del self._buffer[: self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def flush(self):
+        self.fout.flush()
+
+    def _submit(self, block):
+        self._members += 1
+        if self._executor is None:
+            self.fout.write(compress_member(block, self.level))
+            return
+        self._pending.append(self._executor.submit(compress_member, block, self.level))
+        # Write whatever is already compressed and never queue more than
+        # _max_pending blocks
+        while self._pending and (
+            len(self._pending) >= self._max_pending or self._pending[0].done()
+        ):
+            self.fout.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._buffer or not self._members:
+            # An empty stream still has to be a valid gzip file
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self.fout.write(self._pending.popleft().result())
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def abort(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+class _Closed(Exception):
+    pass
+
+
+class ParallelGzipReader:
+    # File-like reader of a gzip stream. Members written by ParallelGzipWriter
+    # are inflated by a thread pool; any other gzip stream is inflated by one
+    # background thread, ahead of the reader.
+    def __init__(self, fin, threads=GZIP_THREADS):
+        self.fin = fin
+        self._executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self._queue = queue.Queue(maxsize=2 * max(1, threads) + 2)
+        self._chunk = b""
+        self._pos = 0
+        self._eof = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(READ_SIZE), b""))
+        while self._pos >= len(self._chunk):
+            if self._eof:
+                return b""
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+                return b""
+            if isinstance(item, BaseException):
+                self._eof = True
+                raise item
+            self._chunk = item if isinstance(item, bytes) else item.result()
+            self._pos = 0
+        data = self._chunk[self._pos : self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._closed = True
+        # Unblock the producer when it waits on a full queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+
+    def _put(self, item):
+        while True:
+            if self._closed:
+                raise _Closed
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _produce(self):
+        try:
+            self._inflate()
+            self._put(None)
+        except _Closed:
+            pass
+        except BaseException as e:
+            try:
+                self._put(e)
+            except _Closed:
+                pass
+
+    def _fill(self, buf, size):
+        while len(buf) < size:
+            data = self.fin.read(READ_SIZE)
+            if not data:
+                return False
+            buf += data
+        return True
+
+    def _inflate(self):
+        buf = bytearray()
+        while self._fill(buf, 1):
+            self._fill(buf, _HEADER_SIZE)
+            size = member_size(buf) if self._executor is not None else None
+            if size is None:
+                self._inflate_stream(bytes(buf))
+                return
+            if not self._fill(buf, size):
+                raise EOFError(
+                    "Compressed file ended before the end-of-stream marker was reached"
+                )
+            member = bytes(buf[:size])
+            del buf[:size]
+            self._put(self._executor.submit(zlib.decompress, member, 31))
+
+    def _inflate_stream(self, data):
+        # Sequential inflate of any gzip stream, member after member
+        inflate = zlib.decompressobj(31)
+        started = False
+        more = False
+        while True:
+            if not data and not more:
+                data = self.fin.read(READ_SIZE)
+                if not data:
+                    if started:
+                        raise EOFError(
+                            "Compressed file ended before the end-of-stream "
+                            "marker was reached"
+                        )
+                    return
+            started = True
+            out = inflate.decompress(data, READ_SIZE)
+            # Output cut at READ_SIZE: zlib may still hold some of it
+            more = len(out) == READ_SIZE
+            if out:
+                self._put(out)
+            if inflate.eof:
+                # Next member, if any; gzip allows zero padding at the end
+                data = inflate.unused_data.lstrip(b"\x00")
+                inflate = zlib.decompressobj(31)
+                started = more = False
+            else:
+                data = inflate.unconsumed_tail
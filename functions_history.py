@@ -0,0 +1,191 @@
+import os, sqlite3, threading, time, uuid
+from datetime import datetime
+
+from constants import HISTORY_PATH
+
+# Every number provisioned, one row per VSR and LRT it was added to, updated
+# in or removed from (operation) and per ARAMIS file it was exported to (tab
+# is then DDI or SN, vsr and next NULL)
+HISTORY_DB = os.path.join(HISTORY_PATH, "history.sqlite3")
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    time REAL NOT NULL,
+    task TEXT,
+    input_file TEXT
+);
+CREATE TABLE IF NOT EXISTS provisioned (
+    number TEXT NOT NULL,
+    enterprise TEXT,
+    domain TEXT,
+    tab TEXT NOT NULL,
+    vsr TEXT,
+    next TEXT,
+    run_id TEXT NOT NULL REFERENCES runs (run_id),
+    time REAL NOT NULL,
+    operation TEXT NOT NULL DEFAULT 'add'
+);
+CREATE INDEX IF NOT EXISTS provisioned_number ON provisioned (number);
+CREATE INDEX IF NOT EXISTS provisioned_enterprise ON provisioned (enterprise, time);
+CREATE INDEX IF NOT EXISTS provisioned_time ON provisioned (time);
+CREATE INDEX IF NOT EXISTS provisioned_run ON provisioned (run_id);
+"""
+HISTORY_COLUMNS = [
+    "number",
+    "enterprise",
+    "domain",
+    "tab",
+    "vsr",
+    "next",
+    "operation",
+    "run_id",
+    "time",
+]
+
+
+def connect_history(db_file=HISTORY_DB):
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+    db = sqlite3.connect(db_file)
+    db.executescript(_SCHEMA)
+    columns = [row[1] for row in db.execute("PRAGMA table_info(provisioned)")]
+    if "operation" not in columns:
+        # Databases created before updates and removals were recorded
+        db.execute(
+            "ALTER TABLE provisioned ADD COLUMN operation TEXT NOT NULL DEFAULT 'add'"
+        )
+    return db
+
+
+class ProvisioningHistory:
+    # Rows provisioned by one task, kept in memory while it runs and written
+    # to the database in one transaction by save
+    def __init__(self, task=None, input_file=None, enterprise=None, run_id=None):
+        if run_id is None:
+            run_id = f"{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}"
+        self.run_id = run_id
+        self.task = task
+        self.input_file = input_file
+        self.enterprise = enterprise
+        self.time = time.time()
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def add_routes(
+        self, vsr_name, domain, tab, routes, enterprise=None, operation="add"
+    ):
+        if enterprise is None:
+            enterprise = self.enterprise
+        rows = [
+            (number, enterprise, domain, tab, vsr_name, next_text, operation)
+            for number, next_text in routes
+        ]
+        with self._lock:
+            self.rows.extend(rows)
+
+    def add_plan(self, written, operation="add"):
+        # written maps every VSR to the routes its LRTs got,
+        # {vsr_name: {(domain, table): [(number, next)]}}
+        for vsr_name, work in written.items():
+            for (domain, tab), routes in work.items():
+                self.add_routes(vsr_name, domain, tab, routes, None, operation)
+
+    def add_export(self, kind, numbers, enterprise=None, domain=None):
+        if enterprise is None:
+            enterprise = self.enterprise
+        rows = [
+            (number, enterprise, domain, kind, None, None, "add") for number in numbers
+        ]
+        with self._lock:
+            self.rows.extend(rows)
+
+    def save(self, db_file=HISTORY_DB):
+        # Returns the number of rows written
+        with self._lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return 0
+        db = connect_history(db_file)
+        try:
+            with db:
+                db.execute(
+                    "INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?)",
+                    (self.run_id, self.time, self.task, self.input_file),
+                )
+                db.executemany(
+                    f"INSERT INTO provisioned ({', '.join(HISTORY_COLUMNS)}) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (row + (self.run_id, self.time) for row in rows),
+                )
+        finally:
+            db.close()
+        return len(rows)
+
+
+def _prefix_end(prefix):
+    # Smallest string greater than every string starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def find_history(
+    number=None,
+    prefix=None,
+    enterprise=None,
+    since=None,
+    until=None,
+    run_id=None,
+    limit=None,
+    db_file=HISTORY_DB,
+):
+    # Rows matching every given filter, newest first, as dicts with
+    # HISTORY_COLUMNS. Each filter is answered from an index.
+    where = []
+    params = []
+    if number is not None:
+        where.append("number = ?")
+        params.append(number)
+    if prefix:
+        where.append("number >= ? AND number < ?")
+        params += [prefix, _prefix_end(prefix)]
+    if enterprise is not None:
+        where.append("enterprise = ?")
+        params.append(enterprise)
+    if since is not None:
+        where.append("time >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("time <= ?")
+        params.append(until)
+    if run_id is not None:
+        where.append("run_id = ?")
+        params.append(run_id)
+    query = f"SELECT {', '.join(HISTORY_COLUMNS)} FROM provisioned"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY time DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    if not os.path.exists(db_file):
+        return []
+    db = connect_history(db_file)
+    try:
+        return [dict(zip(HISTORY_COLUMNS, row)) for row in db.execute(query, params)]
+    finally:
+        db.close()
+
+
+def format_history(row):
+    when = datetime.fromtimestamp(row["time"]).strftime("%d/%m/%Y %H:%M:%S")
+    return "\t".join(
+        [
+            when,
+            row["number"],
+            row["enterprise"] or "-",
+            row["domain"] or "-",
+            row["tab"],
+            row["vsr"] or "-",
+            row["next"] or "-",
+            row["run_id"],
+            row["operation"],
+        ]
+    )
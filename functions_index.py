@@ -0,0 +1,137 @@
+import json, os, threading
+from collections import OrderedDict
+
+from constants import WORKING_PATH
+
+INDEX_PATH = os.path.join(WORKING_PATH, "index")
+# What to do with a number already present in the LRT:
+# skip it, report it but add it anyway, or abort the table
+DUPLICATES = "skip"
+DUPLICATE_POLICIES = ["skip", "report", "error"]
+# Route indexes also kept in memory, least recently used dropped first. Only
+# long-running processes (edit_lrt_daemon.py) turn it on with
+# set_index_cache_size; every run of edit_lrt.py reads them once anyway.
+_index_cache = OrderedDict()
+_index_cache_size = 0
+_index_cache_lock = threading.Lock()
+
+
+class DuplicateRouteError(ValueError):
+    pass
+
+
+class RouteIndex:
+    # Set of the <user> numbers of one LRT. complete is False while the
+    # numbers still have to be collected from the LRT stream.
+    __slots__ = ("users", "complete")
+
+    def __init__(self, users=None):
+        self.complete = users is not None
+        self.users = set() if users is None else users
+
+    def __contains__(self, number):
+        return number in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def select(self, routes, duplicates, logger_name):
+        # Lazily filters the new routes, so it must be consumed only after the
+        # existing numbers were collected
+        if duplicates not in DUPLICATE_POLICIES:
+            raise ValueError(f"Unknown duplicates policy {duplicates!r}")
+        return self._select(routes, duplicates, logger_name)
+
+    def _select(self, routes, duplicates, logger_name):
+        for number, next_text in routes:
+            if number in self.users:
+                if duplicates == "error":
+                    raise DuplicateRouteError(f"Number {number} already in the LRT")
+                if duplicates == "skip":
+                    logger_name.warning(f"Number {number} already in the LRT, skipped")
+                    continue
+                logger_name.warning(f"Number {number} already in the LRT")
+            self.users.add(number)
+            yield number, next_text
+
+
+def route_index_file(vsr_name, domain, table):
+    return os.path.join(INDEX_PATH, vsr_name, f"{table}.{domain}.json")
+
+
+def set_index_cache_size(size):
+    global _index_cache_size
+    with _index_cache_lock:
+        _index_cache_size = size
+        while len(_index_cache) > size:
+            _index_cache.popitem(last=False)
+
+
+def index_cache_len():
+    with _index_cache_lock:
+        return len(_index_cache)
+
+
+def _cache_index(key, data):
+    with _index_cache_lock:
+        if not _index_cache_size:
+            return
+        _index_cache[key] = data
+        _index_cache.move_to_end(key)
+        while len(_index_cache) > _index_cache_size:
+            _index_cache.popitem(last=False)
+
+
+def _cached_index(key):
+    with _index_cache_lock:
+        data = _index_cache.get(key)
+        if data is not None:
+            _index_cache.move_to_end(key)
+        return data
+
+
+def _is_fresh(data, attrs, sha256):
+    return (sha256 is not None and data.get("sha256") == sha256) or (
+        attrs is not None
+        and data.get("size") == attrs.st_size
+        and data.get("mtime") == attrs.st_mtime
+    )
+
+
+def load_route_index(vsr_name, domain, table, attrs=None, sha256=None):
+    # Returns a complete RouteIndex when the cached one still matches the
+    # remote size/mtime or the content hash of the LRT, else an empty one
+    key = (vsr_name, domain, table)
+    data = _cached_index(key)
+    if data is not None and _is_fresh(data, attrs, sha256):
+        return RouteIndex(set(data["numbers"]))
+    try:
+        with open(route_index_file(vsr_name, domain, table)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return RouteIndex()
+    if not _is_fresh(data, attrs, sha256):
+        return RouteIndex()
+    data["numbers"] = frozenset(data["numbers"])
+    _cache_index(key, data)
+    return RouteIndex(set(data["numbers"]))
+
+
+def save_route_index(vsr_name, domain, table, index, attrs=None, sha256=None):
+    index_file = route_index_file(vsr_name, domain, table)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    data = {
+        "size": attrs.st_size if attrs is not None else None,
+        "mtime": attrs.st_mtime if attrs is not None else None,
+        "sha256": sha256,
+        "numbers": sorted(index.users),
+    }
+    with open(index_file + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(index_file + ".tmp", index_file)
+    data["numbers"] = frozenset(index.users)
+    _cache_index((vsr_name, domain, table), data)
+
+
+def find_duplicates(numbers, index):
+    return [number for number in numbers if number in index]
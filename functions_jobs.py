@@ -0,0 +1,300 @@
+import csv, json, os
+from itertools import groupby
+
+from functions_edit_lrt import (
+    ARAMIS_EXPORTS,
+    LRT_TABLES,
+    MAX_WORKERS,
+    OPERATION,
+    OPERATIONS,
+    create_aramis_files,
+    edit_lrt_plan,
+    operation_routes,
+    preflight_input,
+    read_records,
+    save_output_file,
+)
+from functions_index import DUPLICATES
+from functions_metrics import TaskMetrics
+from constants import INPUT_PATH, VSR_NAME
+
+# What each task of the menu does: the LRTs it edits (None when they come
+# from the job) and the ARAMIS file it exports afterwards
+JOB_TASKS = {
+    "1": {"tables": None, "export": None},
+    "2": {"tables": [], "export": "DDI"},
+    "3": {"tables": None, "export": "DDI"},
+    "4": {"tables": ["R"], "export": "SN"},
+}
+JOB_FIELDS = ["task", "file", "customer", "domain", "tables", "vsrs", "operation"]
+
+
+def read_job_file(job_file):
+    # Returns the raw jobs of a JSON, YAML or CSV manifest. JSON and YAML hold
+    # a list of jobs or {"jobs": [...]}; CSV has a header with JOB_FIELDS and
+    # tables/vsrs separated by spaces.
+    ext = os.path.splitext(job_file)[1].lower()
+    with open(job_file, "r", newline="") as f:
+        if ext == ".json":
+            data = json.load(f)
+        elif ext in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is needed to read YAML job files")
+            data = yaml.safe_load(f)
+        elif ext == ".csv":
+            data = list(csv.DictReader(f))
+        else:
+            raise ValueError(f"{job_file} is not a JSON, YAML or CSV job file")
+    if isinstance(data, dict):
+        data = data.get("jobs")
+    if not isinstance(data, list) or not data:
+        raise ValueError(f"{job_file} does not list any job")
+    return data
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return value.split()
+    return [str(item) for item in value]
+
+
+def load_jobs(job_file):
+    return parse_jobs(read_job_file(job_file))
+
+
+def parse_jobs(raw_jobs):
+    # Validates every raw job like the menu validates its inputs
+    jobs = []
+    for n, raw in enumerate(raw_jobs, 1):
+        if not isinstance(raw, dict):
+            raise ValueError(f"Job {n}: expected a mapping with {JOB_FIELDS}")
+        task = str(raw.get("task", "")).strip()
+        if task not in JOB_TASKS:
+            raise ValueError(f"Job {n}: task must be one of {', '.join(JOB_TASKS)}")
+        spec = JOB_TASKS[task]
+        job = {
+            "task": task,
+            "file": str(raw.get("file") or "").strip(),
+            "customer": str(raw.get("customer") or "").replace(" ", ""),
+            "domain": str(raw.get("domain") or "").replace(" ", ""),
+            "tables": [t.upper() for t in _as_list(raw.get("tables"))],
+            "vsrs": [v.lower() for v in _as_list(raw.get("vsrs"))],
+            "export": spec["export"],
+            "operation": str(raw.get("operation") or OPERATION).strip().lower(),
+        }
+        if job["operation"] not in OPERATIONS:
+            raise ValueError(
+                f"Job {n}: operation must be one of {', '.join(OPERATIONS)}"
+            )
+        if job["operation"] != OPERATION and task != "1":
+            raise ValueError(f"Job {n}: only task 1 can update or remove routes")
+        if spec["tables"] is not None:
+            job["tables"] = list(spec["tables"])
+        if not job["file"].endswith(".csv"):
+            raise ValueError(f"Job {n}: {job['file']!r} is not a valid *.csv file")
+        job["file"] = os.path.join(INPUT_PATH, job["file"])
+        if not os.path.isfile(job["file"]):
+            raise ValueError(f"Job {n}: {job['file']} not found")
+        if job["export"] and not job["customer"]:
+            raise ValueError(f"Job {n}: enter a valid ENTERPRISE name")
+        if job["tables"]:
+            if not job["domain"]:
+                raise ValueError(f"Job {n}: enter a valid domain")
+            if not all(t in LRT_TABLES for t in job["tables"]):
+                raise ValueError(
+                    f"Job {n}: enter a valid LRT ({', '.join(LRT_TABLES)})"
+                )
+            if not job["vsrs"] or not all(v in VSR_NAME for v in job["vsrs"]):
+                raise ValueError(f"Job {n}: enter a valid VSR hostname")
+        elif task == "1":
+            raise ValueError(f"Job {n}: enter the name of the LRTs")
+        jobs.append(job)
+    return jobs
+
+
+def read_job_records(jobs):
+    # {input file: records}, each file parsed once whatever the jobs using it
+    return {job["file"]: read_records(job["file"]) for job in jobs}
+
+
+def plan_jobs(jobs, metrics=None, records=None, rendered=None, problems=None):
+    # Groups the routes of every job by VSR, so each router gets one session
+    # and each (domain, table) on it is edited once with the rows of all jobs.
+    # The jobs must share one operation. rendered gets the routes of every
+    # (input file, domain, table, operation). A number given the same route
+    # by several jobs is planned once; one given different routes is added
+    # to problems.
+    if metrics is None:
+        metrics = TaskMetrics()
+    if records is None:
+        records = read_job_records(jobs)
+    if rendered is None:
+        rendered = {}
+    if problems is None:
+        problems = []
+    plan = {}
+    # {(vsr, domain, table): {number: (next, input file)}}
+    planned = {}
+    for job in jobs:
+        if not job["tables"]:
+            continue
+        rows = records[job["file"]]
+        for tab in job["tables"]:
+            key = (job["file"], job["domain"], tab, job["operation"])
+            if key not in rendered:
+                with metrics.stage("render", table=tab, rows=len(rows)):
+                    rendered[key] = operation_routes(
+                        tab, rows, job["domain"], job["operation"]
+                    )
+            source = os.path.basename(job["file"])
+            for vsr_name in job["vsrs"]:
+                routes = plan.setdefault(vsr_name, {}).setdefault(
+                    (job["domain"], tab), []
+                )
+                numbers = planned.setdefault((vsr_name, job["domain"], tab), {})
+                for number, next_text in rendered[key]:
+                    first = numbers.get(number)
+                    if first is None:
+                        numbers[number] = (next_text, source)
+                        routes.append((number, next_text))
+                    elif first[0] != next_text:
+                        problem = (
+                            f"{number} given different routes for {tab}."
+                            f"{job['domain']} in {vsr_name} by {first[1]} "
+                            f"({first[0]}) and {source} ({next_text})"
+                        )
+                        if problem not in problems:
+                            problems.append(problem)
+    return plan
+
+
+def add_job_history(history, jobs, rendered, written):
+    # Every job gets, under its customer, the routes of its file the VSRs
+    # actually got; written is what edit_lrt_plan filled in
+    for job in jobs:
+        for tab in job["tables"]:
+            key = (job["file"], job["domain"], tab, job["operation"])
+            numbers = {number for number, next_text in rendered[key]}
+            for vsr_name in job["vsrs"]:
+                routes = written.get(vsr_name, {}).get((job["domain"], tab), [])
+                history.add_routes(
+                    vsr_name,
+                    job["domain"],
+                    tab,
+                    [route for route in routes if route[0] in numbers],
+                    job["customer"] or None,
+                    job["operation"],
+                )
+
+
+def run_jobs(
+    jobs,
+    logger_name,
+    max_workers=MAX_WORKERS,
+    duplicates=DUPLICATES,
+    metrics=None,
+    sessions=None,
+    resume=False,
+    history=None,
+):
+    # Returns {vsr_name: [errors]} for the VSRs that failed, or {"job n":
+    # [problems]} when the preflight rejected the input of some job. The
+    # export of a job only runs when every VSR of the job succeeded. history
+    # gets what every job provisioned, under the job's customer. Consecutive
+    # jobs with the same operation are worked together, in the order given.
+    if metrics is None:
+        metrics = TaskMetrics()
+    records = read_job_records(jobs)
+    # Every job is validated before any VSR is touched
+    fails = {}
+    for n, job in enumerate(jobs, 1):
+        exports = [job["export"]] if job["export"] else []
+        # Removing routes only needs the numbers
+        tables = job["tables"] if job["operation"] != "remove" else []
+        errors = preflight_input(
+            records[job["file"]], tables, exports, logger_name, metrics
+        )
+        if errors:
+            fails[f"job {n}"] = errors["input file"]
+    if fails:
+        return fails
+    # Every plan is built, and checked for numbers the jobs disagree on,
+    # before any VSR is touched too
+    rendered = {}
+    problems = []
+    groups = [
+        (operation, list(group))
+        for operation, group in groupby(jobs, key=lambda job: job["operation"])
+    ]
+    plans = [
+        (operation, group, plan_jobs(group, metrics, records, rendered, problems))
+        for operation, group in groups
+    ]
+    if problems:
+        logger_name.error(
+            f"The jobs disagree on {len(problems)} route(s), nothing was sent "
+            "to the VSRs:\n" + "\n".join(problems)
+        )
+        return {"jobs": problems}
+    for operation, group, plan in plans:
+        for vsr_name in list(plan):
+            if vsr_name in fails:
+                logger_name.error(
+                    f"Jobs to {operation} routes skipped in {vsr_name}, "
+                    "it failed before"
+                )
+                del plan[vsr_name]
+        for vsr_name, work in plan.items():
+            logger_name.info(
+                f"Plan for {vsr_name}: "
+                + ", ".join(
+                    f"{operation} {tab}.{domain} ({len(routes)} routes)"
+                    for (domain, tab), routes in work.items()
+                )
+            )
+        written = {}
+        if plan:
+            fails.update(
+                edit_lrt_plan(
+                    plan,
+                    logger_name,
+                    max_workers,
+                    sessions,
+                    duplicates,
+                    metrics,
+                    resume,
+                    operation=operation,
+                    written=written,
+                )
+            )
+        if history is not None:
+            add_job_history(history, group, rendered, written)
+    for n, job in enumerate(jobs, 1):
+        if not job["export"]:
+            continue
+        failed = [vsr_name for vsr_name in job["vsrs"] if vsr_name in fails]
+        if failed:
+            logger_name.error(
+                f"Job {n}: {job['export']} file for {job['customer']} not "
+                f"generated, errors in {', '.join(failed)}"
+            )
+            continue
+        # Every export overwrites the same file, so it goes to the history
+        # under the customer's name before the next job runs
+        create_aramis_files(
+            job["file"],
+            job["customer"],
+            logger_name,
+            [job["export"]],
+            metrics,
+            records[job["file"]],
+            history,
+        )
+        save_output_file(
+            ARAMIS_EXPORTS[job["export"]]["file"], logger_name, job["customer"]
+        )
+    return fails
@@ -0,0 +1,134 @@
+import json, os, shutil, threading, time
+
+from functions_files import link_or_copy
+from constants import WORKING_PATH
+
+# One folder per run: journal/<run id>/journal.jsonl has one line per stage
+# completed {time, vsr, domain, table, stage, ...}, and the edited LRTs are
+# kept next to it as <sha256>.xml.gz until the run succeeds
+JOURNAL_PATH = os.path.join(WORKING_PATH, "journal")
+# Journals of runs never resumed are removed after this many seconds
+JOURNAL_MAX_AGE = 7 * 24 * 3600
+
+
+def _same(attrs, recorded):
+    return (
+        attrs is not None
+        and recorded is not None
+        and attrs.st_size == recorded["size"]
+        and attrs.st_mtime == recorded["mtime"]
+    )
+
+
+def file_attrs(attrs):
+    return {"size": attrs.st_size, "mtime": attrs.st_mtime}
+
+
+class RunJournal:
+    # Stages completed per VSR and table by a run. run_id identifies the work
+    # (VSRs, tables and routes), so only a run of the same work resumes it.
+    def __init__(self, run_id, resume=False):
+        self.path = os.path.join(JOURNAL_PATH, run_id)
+        self.file = os.path.join(self.path, "journal.jsonl")
+        self.resumed = False
+        self._states = {}
+        self._lock = threading.Lock()
+        if resume:
+            self._load()
+        elif os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def _load(self):
+        try:
+            with open(self.file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut by a crash in the middle of a write
+                        continue
+                    key = (record["vsr"], record["domain"], record["table"])
+                    self._states.setdefault(key, {}).update(record)
+                    self.resumed = True
+        except OSError:
+            pass
+
+    def record(self, vsr_name, domain, table, stage, **data):
+        record = {
+            "time": time.time(),
+            "vsr": vsr_name,
+            "domain": domain,
+            "table": table,
+            "stage": stage,
+            **data,
+        }
+        with self._lock:
+            self._states.setdefault((vsr_name, domain, table), {}).update(record)
+            with open(self.file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def state(self, vsr_name, domain=None, table=None):
+        # Everything recorded so far for the VSR/table, the last stage in
+        # "stage"; None when nothing was
+        with self._lock:
+            state = self._states.get((vsr_name, domain, table))
+            return dict(state) if state is not None else None
+
+    def staged_file(self, sha256):
+        return os.path.join(self.path, sha256 + ".xml.gz")
+
+    def keep(self, src_file, sha256):
+        # Keeps the edited LRT for a resume, whatever happens to src_file
+        kept = self.staged_file(sha256)
+        if not os.path.exists(kept):
+            link_or_copy(src_file, kept)
+        return kept
+
+    def resume_point(self, vsr_name, domain, table, live, tmp=None):
+        # Where the work of a table continues, given the attrs of the live LRT
+        # and of its .tmp on the VSR: "renamed" when the live LRT is already
+        # the edited one, "uploaded" when the edited one waits in the .tmp,
+        # "edited" when only the upload is missing, None to work it from the
+        # start (nothing recorded, or the LRT changed since)
+        state = self.state(vsr_name, domain, table)
+        if state is None:
+            return None, None
+        if state["stage"] in ("uploaded", "renamed") and _same(
+            live, state.get("upload")
+        ):
+            return "renamed", state
+        if state["stage"] == "uploaded" and _same(tmp, state.get("upload")):
+            return "uploaded", state
+        if (
+            state["stage"] in ("edited", "uploaded")
+            and _same(live, state.get("source"))
+            and os.path.exists(self.staged_file(state["sha256"]))
+        ):
+            return "edited", state
+        return None, None
+
+    def close(self, done):
+        # A run that succeeded leaves nothing to resume
+        if done:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def prune_journals(max_age=JOURNAL_MAX_AGE):
+    # Removes the journals not written for max_age seconds. Returns how many.
+    removed = 0
+    if not os.path.isdir(JOURNAL_PATH):
+        return removed
+    now = time.time()
+    for run_id in os.listdir(JOURNAL_PATH):
+        path = os.path.join(JOURNAL_PATH, run_id)
+        try:
+            age = now - os.path.getmtime(os.path.join(path, "journal.jsonl"))
+        except OSError:
+            age = now - os.path.getmtime(path)
+        if age > max_age:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
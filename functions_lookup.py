@@ -0,0 +1,192 @@
+import json, os, re
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+
+from functions_cache import MIRROR_PATH
+from functions_edit_lrt import LRT_TABLES, MAX_WORKERS, VsrLoggerAdapter, sync_lrt
+from functions_gzip import ParallelGzipReader
+from functions_lrt import iter_routes
+from constants import REMOTE_PATH, VSRS, WORKING_PATH
+
+# Longest-prefix indexes of the routes of every LRT in the local mirror:
+# lookup/<vsr>/<T>.<domain>.json with the sorted users, their nexts and the
+# sha256 of the mirror copy they were built from
+LOOKUP_PATH = os.path.join(WORKING_PATH, "lookup")
+_LRT_NAME = re.compile(r"([^.]+)\.(.+)\.xml\.gz$")
+
+
+class PrefixIndex:
+    # Sorted <user> values with their <next>. lookup tries the prefixes of
+    # the number from the longest user length down, with a binary search each.
+    __slots__ = ("users", "nexts", "lengths", "sha256")
+
+    def __init__(self, users, nexts, sha256=None):
+        self.users = users
+        self.nexts = nexts
+        self.sha256 = sha256
+        self.lengths = sorted({len(user) for user in users}, reverse=True)
+
+    @classmethod
+    def from_routes(cls, routes, sha256=None):
+        # The first route of a repeated user wins
+        table = {}
+        for user, next_text in routes:
+            table.setdefault(user, next_text)
+        users = sorted(table)
+        return cls(users, [table[user] for user in users], sha256)
+
+    def __len__(self):
+        return len(self.users)
+
+    def lookup(self, number):
+        # (matched user, next) for the longest user that prefixes number
+        users = self.users
+        for length in self.lengths:
+            if length > len(number):
+                continue
+            prefix = number[:length]
+            i = bisect_left(users, prefix)
+            if i < len(users) and users[i] == prefix:
+                return prefix, self.nexts[i]
+        return None
+
+
+def lookup_index_file(vsr_name, domain, table):
+    return os.path.join(LOOKUP_PATH, vsr_name, f"{table}.{domain}.json")
+
+
+def mirrored_lrts(vsrs=None, domains=None, tables=None):
+    # {(vsr, domain, table): sha256} of the LRTs in the local mirror
+    lrts = {}
+    if not os.path.isdir(MIRROR_PATH):
+        return lrts
+    for vsr_name in os.listdir(MIRROR_PATH):
+        if vsrs and vsr_name not in vsrs:
+            continue
+        vsr_path = os.path.join(MIRROR_PATH, vsr_name)
+        for name in os.listdir(vsr_path):
+            m = _LRT_NAME.fullmatch(name)
+            if m is None:
+                continue
+            table, domain = m.groups()
+            if (domains and domain not in domains) or (tables and table not in tables):
+                continue
+            try:
+                with open(os.path.join(vsr_path, name + ".json")) as f:
+                    sha256 = json.load(f)["sha256"]
+            except (OSError, ValueError, KeyError):
+                continue
+            lrts[(vsr_name, domain, table)] = sha256
+    return lrts
+
+
+def build_prefix_index(vsr_name, domain, table, sha256):
+    mirror = os.path.join(MIRROR_PATH, vsr_name, f"{table}.{domain}.xml.gz")
+    with open(mirror, "rb") as raw, ParallelGzipReader(raw) as fin:
+        index = PrefixIndex.from_routes(iter_routes(fin), sha256)
+    index_file = lookup_index_file(vsr_name, domain, table)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    with open(index_file + ".tmp", "w") as f:
+        json.dump({"sha256": sha256, "users": index.users, "nexts": index.nexts}, f)
+    os.replace(index_file + ".tmp", index_file)
+    return index
+
+
+def load_prefix_index(vsr_name, domain, table, sha256):
+    # The saved index when it was built from the same mirror content
+    try:
+        with open(lookup_index_file(vsr_name, domain, table)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("sha256") != sha256:
+        return None
+    return PrefixIndex(data["users"], data["nexts"], sha256)
+
+
+def load_lookup_indexes(vsrs=None, domains=None, tables=None, logger_name=None):
+    # {(vsr, domain, table): PrefixIndex} for every mirrored LRT; only the
+    # LRTs whose mirror changed since their index was saved are parsed again
+    indexes = {}
+    for (vsr_name, domain, table), sha256 in sorted(
+        mirrored_lrts(vsrs, domains, tables).items()
+    ):
+        index = load_prefix_index(vsr_name, domain, table, sha256)
+        if index is None:
+            index = build_prefix_index(vsr_name, domain, table, sha256)
+            if logger_name is not None:
+                logger_name.info(
+                    f"Lookup index of {table}.{domain} in {vsr_name} rebuilt "
+                    f"({len(index)} routes)"
+                )
+        indexes[(vsr_name, domain, table)] = index
+    return indexes
+
+
+def lookup_number(indexes, number):
+    # [(vsr, domain, table, matched user, next)] for every LRT routing number
+    number = re.sub(r"[\s+()-]", "", number)
+    matches = []
+    for (vsr_name, domain, table), index in indexes.items():
+        match = index.lookup(number)
+        if match is not None:
+            matches.append((vsr_name, domain, table) + match)
+    return matches
+
+
+def sync_vsr_mirror(vsr_name, domains, tables, logger_name, sessions):
+    # Brings the local mirror of the LRTs of one VSR up to date. Returns the
+    # number of LRTs synced.
+    vsr_logger = VsrLoggerAdapter(logger_name, {"vsr": vsr_name})
+    sftp = sessions.open_sftp(VSRS.get(vsr_name))
+    lrts = 0
+    try:
+        for attrs in sftp.listdir_attr(REMOTE_PATH):
+            m = _LRT_NAME.fullmatch(attrs.filename)
+            if m is None or m.group(1) not in LRT_TABLES:
+                continue
+            table, domain = m.groups()
+            if (domains and domain not in domains) or (tables and table not in tables):
+                continue
+            sync_lrt(
+                sftp,
+                REMOTE_PATH,
+                attrs.filename,
+                attrs,
+                (vsr_name, domain, table),
+                vsr_logger,
+            )
+            lrts += 1
+    finally:
+        sftp.close()
+    return lrts
+
+
+def sync_mirrors(
+    vsrs, domains, tables, logger_name, max_workers=MAX_WORKERS, sessions=None
+):
+    # Returns {vsr_name: error} only for the VSRs that could not be synced
+    from functions_socks import SessionManager
+
+    fails = {}
+    own_sessions = sessions is None
+    if own_sessions:
+        sessions = SessionManager()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {
+                vsr_name: executor.submit(
+                    sync_vsr_mirror, vsr_name, domains, tables, logger_name, sessions
+                )
+                for vsr_name in vsrs
+            }
+            for vsr_name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger_name.exception(f"Sync of {vsr_name} failed: {e}")
+                    fails[vsr_name] = f"{type(e).__name__}: {e}"
+    finally:
+        if own_sessions:
+            sessions.close_all()
+    return fails
@@ -0,0 +1,280 @@
+import hashlib, re, time
+
+from functions_gzip import GZIP_THREADS, ParallelGzipReader, ParallelGzipWriter
+from functions_metrics import TimedReader, TimedWriter, stream_stage_timings
+
+# Bytes read from the source LRT on every step of the streaming edit
+CHUNK_SIZE = 1024 * 1024
+# Bytes held back from the end of the stream to find the closing root tag
+TAIL_SIZE = 64 * 1024
+
+# gzip level for the edited LRTs, as gzip.open used before
+GZIP_LEVEL = 9
+
+# Same layout etree.indent + etree.tostring(pretty_print=True) produce
+ROUTE_TEMPLATE = (
+    "  <route>\n"
+    '    <user type="E164">{user}</user>\n'
+    '    <next type="regex">{next}</next>\n'
+    "  </route>\n"
+)
+
+_CLOSE_ROUTE = b"</route>"
+_ROUTE = re.compile(rb"<route\b[^>]*>(.*?)</route>", re.S)
+_USER = re.compile(rb"<user\b[^>]*>\s*([^<]*?)\s*</user>")
+_NEXT = re.compile(rb"<next\b[^>]*>\s*([^<]*?)\s*</next>")
+_CLOSING_ROOT = re.compile(rb"</[^<>/]+>\s*\Z")
+_EMPTY_ROOT = re.compile(rb"<([^\s<>/]+)([^<>]*?)\s*/>(\s*)\Z")
+
+
+def escape(text):
+    # Same as xml.sax.saxutils.escape, without importing urllib with it
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def unescape(text):
+    return (
+        text.replace("&lt;", "<")
+        .replace("&gt;", ">")
+        .replace("&quot;", '"')
+        .replace("&apos;", "'")
+        .replace("&amp;", "&")
+    )
+
+
+def render_route(user, next_text):
+    return ROUTE_TEMPLATE.format(user=escape(user), next=escape(next_text)).encode(
+        "utf-8"
+    )
+
+
+def _collect_users(users, data, end=None):
+    if users is not None:
+        users.update(
+            m.group(1).decode("utf-8")
+            for m in _USER.finditer(data, 0, end or len(data))
+        )
+
+
+def splice_routes(fin, fout, routes, chunk_size=CHUNK_SIZE, users=None):
+    # Copy the LRT from fin to fout chunk by chunk and append the rendered
+    # routes right before the closing root tag. Existing routes are passed
+    # through untouched, so memory stays flat whatever the size of the table.
+    # routes is only consumed once the whole LRT went through, after the
+    # existing <user> numbers were added to users (when a set is given).
+    existing = 0
+    tail = b""
+    while True:
+        chunk = fin.read(chunk_size)
+        if not chunk:
+            break
+        data = tail + chunk
+        cut = len(data) - TAIL_SIZE
+        if cut > 0:
+            # Never split a route between the part written and the part kept
+            route_end = data.rfind(_CLOSE_ROUTE, 0, cut)
+            if route_end >= 0:
+                cut = route_end + len(_CLOSE_ROUTE)
+            else:
+                cut = data.rfind(b"<", 0, cut)
+        if cut > 0:
+            existing += data.count(_CLOSE_ROUTE, 0, cut)
+            _collect_users(users, data, cut)
+            fout.write(data[:cut])
+            tail = data[cut:]
+        else:
+            tail = data
+    existing += tail.count(_CLOSE_ROUTE)
+    _collect_users(users, tail)
+
+    new_routes = b"".join(render_route(user, next_text) for user, next_text in routes)
+    added = new_routes.count(_CLOSE_ROUTE)
+
+    m = _CLOSING_ROOT.search(tail)
+    if m:
+        head = tail[: m.start()]
+        fout.write(head)
+        if new_routes and not head.endswith(b"\n"):
+            fout.write(b"\n")
+        fout.write(new_routes)
+        fout.write(tail[m.start() :])
+        return existing, added
+
+    m = _EMPTY_ROOT.search(tail)
+    if m is None:
+        raise ValueError("Closing root tag not found at the end of the LRT")
+    if not new_routes:
+        fout.write(tail)
+        return existing, added
+    tag, attrs, trailer = m.groups()
+    fout.write(tail[: m.start()])
+    fout.write(b"<" + tag + attrs + b">\n")
+    fout.write(new_routes)
+    fout.write(b"</" + tag + b">" + (trailer or b"\n"))
+    return existing, added
+
+
+def iter_routes(fin, chunk_size=CHUNK_SIZE):
+    # (user, next) of every route of the LRT read from fin, chunk by chunk
+    tail = b""
+    while True:
+        chunk = fin.read(chunk_size)
+        data = tail + chunk
+        cut = len(data)
+        if chunk:
+            cut = data.rfind(_CLOSE_ROUTE) + len(_CLOSE_ROUTE)
+            if cut < len(_CLOSE_ROUTE):
+                cut = 0
+        for m in _ROUTE.finditer(data, 0, cut):
+            user = _USER.search(m.group(1))
+            if user is None:
+                continue
+            next_text = _NEXT.search(m.group(1))
+            yield (
+                unescape(user.group(1).decode("utf-8")),
+                unescape(next_text.group(1).decode("utf-8")) if next_text else "",
+            )
+        tail = data[cut:]
+        if not chunk:
+            return
+
+
+def rewrite_routes(fin, fout, changes, chunk_size=CHUNK_SIZE, users=None):
+    # Copy the LRT from fin to fout chunk by chunk, replacing the <next> of
+    # the numbers changes maps to a new next and dropping the routes of the
+    # numbers it maps to None: one pass and one dict lookup per route, the
+    # rest of the LRT passed through untouched. The <user> numbers kept are
+    # added to users (when a set is given). Returns (routes read, routes
+    # written, set of the numbers found).
+    existing = written = 0
+    found = set()
+    tail = b""
+    while True:
+        chunk = fin.read(chunk_size)
+        data = tail + chunk
+        cut = len(data)
+        if chunk:
+            # The byte after the last route has to be read too, so a route
+            # dropped takes its line break with it
+            cut = data.rfind(_CLOSE_ROUTE, 0, len(data) - 1) + len(_CLOSE_ROUTE)
+            if cut < len(_CLOSE_ROUTE):
+                cut = 0
+            elif data[cut : cut + 1] == b"\n":
+                cut += 1
+        pos = 0
+        for m in _ROUTE.finditer(data, 0, cut):
+            existing += 1
+            written += 1
+            user = _USER.search(m.group(1))
+            number = unescape(user.group(1).decode("utf-8")) if user else None
+            if number not in changes:
+                if users is not None and number is not None:
+                    users.add(number)
+                continue
+            found.add(number)
+            next_text = changes[number]
+            if next_text is None:
+                # The route goes with its indentation and its line break
+                written -= 1
+                start = m.start()
+                while start > pos and data[start - 1 : start] in b" \t":
+                    start -= 1
+                fout.write(data[pos:start])
+                pos = m.end()
+                if data[pos : pos + 1] == b"\n":
+                    pos += 1
+                continue
+            if users is not None:
+                users.add(number)
+            old = _NEXT.search(m.group(1))
+            if old is None:
+                raise ValueError(f"Route of {number} without <next> in the LRT")
+            # Only the text of <next> changes, its tag and the layout stay
+            start = m.start(1) + old.start(1)
+            fout.write(data[pos:start])
+            fout.write(escape(next_text).encode("utf-8"))
+            pos = m.start(1) + old.end(1)
+        fout.write(data[pos:cut])
+        tail = data[cut:]
+        if not chunk:
+            return existing, written, found
+
+
+class HashSink:
+    # Write-only sink keeping the SHA-256 and size of everything written to it
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class TeeReader:
+    # File-like reader that copies every chunk read from fin into the sinks
+    def __init__(self, fin, *sinks):
+        self.fin = fin
+        self.sinks = sinks
+
+    def read(self, size=-1):
+        data = self.fin.read(size)
+        for sink in self.sinks:
+            sink.write(data)
+        return data
+
+
+class TeeWriter:
+    # File-like writer that copies every chunk written to fout into the sinks
+    def __init__(self, fout, *sinks):
+        self.fout = fout
+        self.sinks = sinks
+
+    def write(self, data):
+        self.fout.write(data)
+        for sink in self.sinks:
+            sink.write(data)
+        return len(data)
+
+    def flush(self):
+        self.fout.flush()
+
+
+def edit_gzip_stream(
+    fin,
+    fout,
+    edit,
+    in_sinks=(),
+    out_sinks=(),
+    level=GZIP_LEVEL,
+    timings=None,
+    threads=GZIP_THREADS,
+):
+    # fin yields the .xml.gz as stored on the VSR and fout receives the edited
+    # .xml.gz; the XML itself only ever exists chunk by chunk in between.
+    # in_sinks/out_sinks get a copy of the compressed bytes read/written.
+    # gunzip and gzip run on threads next to the edit (functions_gzip), so
+    # when a dict is given as timings it gets the (seconds, bytes) the edit
+    # spent waiting on each of the read, gunzip, edit, gzip and write stages.
+    start = time.perf_counter()
+    fin = raw_in = TimedReader(fin)
+    fout = raw_out = TimedWriter(fout)
+    if in_sinks:
+        fin = TeeReader(fin, *in_sinks)
+    if out_sinks:
+        fout = TeeWriter(fout, *out_sinks)
+    with ParallelGzipReader(fin, threads) as gz_in:
+        with ParallelGzipWriter(fout, level, threads) as gz_out:
+            xml_in, xml_out = TimedReader(gz_in), TimedWriter(gz_out)
+            result = edit(xml_in, xml_out)
+    if timings is not None:
+        timings.update(
+            stream_stage_timings(
+                time.perf_counter() - start, raw_in, xml_in, xml_out, raw_out
+            )
+        )
+    return result
@@ -0,0 +1,118 @@
+import json, threading, time
+from contextlib import contextmanager
+
+
+class TimedReader:
+    # File-like reader that accumulates the time spent in and bytes returned
+    # by fin.read
+    def __init__(self, fin):
+        self.fin = fin
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.fin.read(size)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return data
+
+
+class TimedWriter:
+    # File-like writer that accumulates the time spent in and bytes given to
+    # fout.write
+    def __init__(self, fout):
+        self.fout = fout
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.fout.write(data)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        self.fout.flush()
+
+
+class TaskMetrics:
+    # Per-stage timings of one task, shared by the threads working the VSRs
+    def __init__(self, task=None):
+        self.task = task
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, vsr=None, table=None, nbytes=None, rows=None):
+        record = {
+            "vsr": vsr,
+            "table": table,
+            "stage": stage,
+            "seconds": round(seconds, 6),
+            "bytes": nbytes,
+            "rows": rows,
+            "bytes_per_s": round(nbytes / seconds) if nbytes and seconds else None,
+            "rows_per_s": round(rows / seconds, 1) if rows and seconds else None,
+        }
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    @contextmanager
+    def stage(self, stage, vsr=None, table=None, nbytes=None, rows=None):
+        # The yielded dict may get "bytes"/"rows" once they are known
+        sizes = {"bytes": nbytes, "rows": rows}
+        start = time.perf_counter()
+        try:
+            yield sizes
+        finally:
+            self.add(
+                stage,
+                time.perf_counter() - start,
+                vsr,
+                table,
+                sizes["bytes"],
+                sizes["rows"],
+            )
+
+    def summary(self):
+        header = f"{'VSR':<14}{'Table':<24}{'Stage':<14}{'Seconds':>10}"
+        header += f"{'MB':>10}{'MB/s':>10}{'Rows':>10}{'Rows/s':>12}"
+        lines = ["Stage timings:", header, "-" * len(header)]
+        total = 0.0
+        with self._lock:
+            records = list(self.records)
+        for r in records:
+            mb = r["bytes"] / 1e6 if r["bytes"] else None
+            mbps = r["bytes_per_s"] / 1e6 if r["bytes_per_s"] else None
+            lines.append(
+                f"{r['vsr'] or '-':<14}{r['table'] or '-':<24}{r['stage']:<14}"
+                f"{r['seconds']:>10.3f}"
+                f"{'' if mb is None else f'{mb:.2f}':>10}"
+                f"{'' if mbps is None else f'{mbps:.2f}':>10}"
+                f"{'' if r['rows'] is None else r['rows']:>10}"
+                f"{'' if r['rows_per_s'] is None else r['rows_per_s']:>12}"
+            )
+            total += r["seconds"]
+        lines.append(f"Total stage time: {total:.3f}s")
+        return "\n".join(lines)
+
+    def write_json(self, json_file):
+        with self._lock:
+            data = {"task": self.task, "stages": list(self.records)}
+        with open(json_file, "w") as f:
+            json.dump(data, f, indent=2)
+        return json_file
+
+
+def stream_stage_timings(total, raw_in, xml_in, xml_out, raw_out):
+    # Splits the time of a fused gunzip -> edit -> gzip stream between its
+    # stages from the timed wrappers around each layer
+    return {
+        "read": (raw_in.seconds, raw_in.bytes),
+        "gunzip": (max(xml_in.seconds - raw_in.seconds, 0.0), xml_in.bytes),
+        "edit": (max(total - xml_in.seconds - xml_out.seconds, 0.0), xml_in.bytes),
+        "gzip": (max(xml_out.seconds - raw_out.seconds, 0.0), xml_out.bytes),
+        "write": (raw_out.seconds, raw_out.bytes),
+    }
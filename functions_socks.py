@@ -1,37 +1,127 @@
-import paramiko, socks
+import socket, threading
 
+# paramiko and socks are imported on the first connection, so the tasks that
+# never reach a VSR do not pay for them
+from functions_transfer import MAX_PACKET_SIZE, WINDOW_SIZE
 from constants import USERNAME, PASSWORD
 
+PROXY_ADDR = "127.0.0.1"
+PROXY_PORT = 1500
+SSH_PORT = 22
+# Seconds between SSH keepalive packets on idle sessions
+KEEPALIVE = 30
+
+
+def create_proxy_socket(
+    host, port=SSH_PORT, proxy_addr=PROXY_ADDR, proxy_port=PROXY_PORT
+):
+    # proxy_addr=None connects straight to the host, without the SOCKS5 proxy
+    if proxy_addr is None:
+        return socket.create_connection((host, port))
+
+    import socks
 
-def create_sftp_connection(host, myuser=USERNAME, mypassword=PASSWORD):
     sock = socks.socksocket()
 
     sock.set_proxy(
         proxy_type=socks.SOCKS5,
-        addr="127.0.0.1",
-        port=1500,
+        addr=proxy_addr,
+        port=proxy_port,
     )
 
-    sock.connect((host, 22))
+    sock.connect((host, port))
+    return sock
 
-    transport = paramiko.Transport(sock)
-    transport.connect(username=myuser, password=mypassword)
-    sftp_conn = paramiko.SFTPClient.from_transport(transport)
-    return sftp_conn, transport
 
+# One authenticated transport per host; SFTP and the refresh shell are opened
+# as channels on it, so a host costs a single proxy connection and handshake.
+class SessionManager:
+    def __init__(
+        self,
+        proxy_addr=PROXY_ADDR,
+        proxy_port=PROXY_PORT,
+        ssh_port=SSH_PORT,
+        keepalive=KEEPALIVE,
+        myuser=USERNAME,
+        mypassword=PASSWORD,
+        window_size=WINDOW_SIZE,
+        max_packet_size=MAX_PACKET_SIZE,
+    ):
+        self.proxy_addr = proxy_addr
+        self.proxy_port = proxy_port
+        self.ssh_port = ssh_port
+        self.keepalive = keepalive
+        self.myuser = myuser
+        self.mypassword = mypassword
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self._transports = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
 
-def create_ssh_connection(host, myuser=USERNAME, mypassword=PASSWORD):
-    sock = socks.socksocket()
+    def __enter__(self):
+        return self
 
-    sock.set_proxy(
-        proxy_type=socks.SOCKS5,
-        addr="127.0.0.1",
-        port=1500,
-    )
+    def __exit__(self, *exc):
+        self.close_all()
+
+    def _host_lock(self, host):
+        with self._lock:
+            return self._host_locks.setdefault(host, threading.Lock())
+
+    def _connect(self, host):
+        sock = create_proxy_socket(
+            host, self.ssh_port, self.proxy_addr, self.proxy_port
+        )
+        import paramiko
+
+        # Every channel opened on the transport (SFTP and shell) gets these
+        transport = paramiko.Transport(
+            sock,
+            default_window_size=self.window_size,
+            default_max_packet_size=self.max_packet_size,
+        )
+        try:
+            transport.connect(username=self.myuser, password=self.mypassword)
+        except Exception:
+            transport.close()
+            raise
+        if self.keepalive:
+            transport.set_keepalive(self.keepalive)
+        return transport
+
+    def get_transport(self, host):
+        with self._host_lock(host):
+            transport = self._transports.get(host)
+            if transport is None or not transport.is_active():
+                transport = self._connect(host)
+                self._transports[host] = transport
+            return transport
+
+    def open_sftp(self, host):
+        import paramiko
+
+        return paramiko.SFTPClient.from_transport(self.get_transport(host))
+
+    def open_shell(self, host):
+        channel = self.get_transport(host).open_session()
+        channel.get_pty()
+        channel.invoke_shell()
+        return channel
+
+    def active_hosts(self):
+        with self._lock:
+            transports = dict(self._transports)
+        return sorted(host for host, t in transports.items() if t.is_active())
 
-    sock.connect((host, 22))
+    def close(self, host):
+        with self._host_lock(host):
+            transport = self._transports.pop(host, None)
+            if transport is not None:
+                transport.close()
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname=host, username=myuser, password=mypassword, sock=sock)
-    return ssh
\ No newline at end of file
+    def close_all(self):
+        with self._lock:
+            hosts = list(self._transports)
+        for host in hosts:
+            self.close(host)
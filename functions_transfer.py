@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# SSH flow control: bytes a channel may have in flight before waiting for the
+# other end. paramiko's 2 MiB default caps a transfer at 2 MiB per round trip
+# through the SOCKS proxy, well below what the link to the VSRs carries.
+WINDOW_SIZE = 16 * 1024 * 1024
+# Largest SSH packet the VSR may send; 32 KiB SFTP reads plus their header fit
+# in one packet instead of two
+MAX_PACKET_SIZE = 64 * 1024
+# Bytes moved per read/write between the local files and the SFTP files
+TRANSFER_BUFFER = 1024 * 1024
+# Tables of one VSR downloaded or uploaded at the same time, each on its own
+# SFTP channel of the VSR's transport
+TRANSFER_THREADS = 4
+
+
+def transfer_rate(seconds, nbytes):
+    # "12.3 MiB in 1.52s (8.1 MiB/s)" for the logs
+    mib = nbytes / (1024 * 1024)
+    rate = mib / seconds if seconds > 0 else 0.0
+    return f"{mib:.1f} MiB in {seconds:.2f}s ({rate:.1f} MiB/s)"
+
+
+class TransferPool:
+    # Runs transfer functions on up to threads SFTP channels of the same host:
+    # submit(fn, *args) calls fn(sftp, *args) on a worker thread, each thread
+    # opening its channel on first use. Leaving the with block waits for the
+    # transfers running and, on an exception, cancels the ones not started.
+    def __init__(self, sessions, host, threads=TRANSFER_THREADS):
+        self.sessions = sessions
+        self.host = host
+        self._executor = ThreadPoolExecutor(threads)
+        self._local = threading.local()
+        self._channels = []
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(cancel=exc_type is not None)
+
+    def _sftp(self):
+        sftp = getattr(self._local, "sftp", None)
+        if sftp is None:
+            sftp = self._local.sftp = self.sessions.open_sftp(self.host)
+            with self._lock:
+                self._channels.append(sftp)
+        return sftp
+
+    def submit(self, fn, *args):
+        future = self._executor.submit(lambda: fn(self._sftp(), *args))
+        self._futures.append(future)
+        return future
+
+    def close(self, cancel=False):
+        if cancel:
+            for future in self._futures:
+                future.cancel()
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            channels, self._channels = self._channels, []
+        for sftp in channels:
+            sftp.close()
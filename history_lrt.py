@@ -0,0 +1,53 @@
+import argparse
+
+from functions_edit_lrt import parse_time
+from functions_history import find_history, format_history
+
+parser = argparse.ArgumentParser(prog="Provisioning history")
+lookup = parser.add_mutually_exclusive_group()
+lookup.add_argument("-n", "--number", dest="number", help="Number provisioned")
+lookup.add_argument(
+    "-p", "--prefix", dest="prefix", help="Numbers starting with this prefix"
+)
+parser.add_argument(
+    "-c", "--customer", dest="customer", help="ENTERPRISE the numbers went to"
+)
+parser.add_argument(
+    "--since",
+    dest="since",
+    type=parse_time,
+    help="Provisioned at or after this time (dd/mm/YYYY [HH:MM:SS])",
+)
+parser.add_argument(
+    "--until",
+    dest="until",
+    type=parse_time,
+    help="Provisioned at or before this time (dd/mm/YYYY [HH:MM:SS])",
+)
+parser.add_argument("-r", "--run", dest="run_id", help="Run ID of the task")
+parser.add_argument(
+    "--limit",
+    dest="limit",
+    default=100,
+    type=int,
+    help="Maximum number of rows shown, 0 for all (default: 100)",
+)
+args = parser.parse_args()
+
+if not any(
+    [args.number, args.prefix, args.customer, args.since, args.until, args.run_id]
+):
+    parser.error("enter at least one of -n, -p, -c, --since, --until, -r")
+
+rows = find_history(
+    number=args.number.lstrip("+") if args.number else None,
+    prefix=args.prefix.lstrip("+") if args.prefix else None,
+    enterprise=args.customer,
+    since=args.since,
+    until=args.until,
+    run_id=args.run_id,
+    limit=args.limit or None,
+)
+for row in rows:
+    print(format_history(row))
+print(f"{len(rows)} row(s) found")
@@ -0,0 +1,94 @@
+import argparse, time
+
+from functions_edit_lrt import (
+    LRT_TABLES,
+    MAX_WORKERS,
+    create_custom_logger,
+    iter_records,
+)
+from functions_lookup import load_lookup_indexes, lookup_number, sync_mirrors
+from constants import INPUT_PATH, LOG_PATH, VSR_NAME
+
+parser = argparse.ArgumentParser(prog="Lookup LRT")
+parser.add_argument("numbers", nargs="*", help="Number(s) to look up")
+parser.add_argument(
+    "-f",
+    "--file",
+    dest="file",
+    help=f"Input file in {INPUT_PATH}, numbers in the first tab separated column",
+)
+parser.add_argument(
+    "-d", "--domains", dest="domains", nargs="+", help="Customer domain(s) to search"
+)
+parser.add_argument(
+    "-t",
+    "--tables",
+    dest="tables",
+    nargs="+",
+    type=str.upper,
+    choices=list(LRT_TABLES),
+    help="LRT(s) to search",
+)
+parser.add_argument(
+    "-v",
+    "--vsrs",
+    dest="vsrs",
+    nargs="+",
+    type=str.lower,
+    choices=VSR_NAME,
+    help="Session Router(s) to search",
+)
+parser.add_argument(
+    "--sync",
+    action="store_true",
+    help="Download the LRTs that changed on the VSRs before the lookup",
+)
+parser.add_argument(
+    "-w",
+    "--workers",
+    dest="workers",
+    default=MAX_WORKERS,
+    type=int,
+    help=f"Number of VSRs to sync at the same time (default: {MAX_WORKERS})",
+)
+args = parser.parse_args()
+
+numbers = list(args.numbers)
+if args.file:
+    # Same tab separated layout as the inputs of edit_lrt.py
+    for record in iter_records(f"{INPUT_PATH}/{args.file}"):
+        number = record.number.strip()
+        if number:
+            numbers.append(number)
+if not numbers:
+    parser.error("enter at least one number or a file with -f")
+
+my_logger, my_logfile = create_custom_logger("Lookup", LOG_PATH)
+if args.sync:
+    fails = sync_mirrors(
+        args.vsrs or VSR_NAME, args.domains, args.tables, my_logger, args.workers
+    )
+    for vsr_name, error in fails.items():
+        print(f"{vsr_name}: sync failed, using the cached LRTs ({error})")
+
+start = time.perf_counter()
+indexes = load_lookup_indexes(args.vsrs, args.domains, args.tables, my_logger)
+loaded = time.perf_counter() - start
+if not indexes:
+    parser.exit(1, "No LRT cached, run with --sync first\n")
+
+start = time.perf_counter()
+found = 0
+for number in numbers:
+    matches = lookup_number(indexes, number)
+    if not matches:
+        print(f"{number}\tnot routed")
+        continue
+    found += 1
+    for vsr_name, domain, table, user, next_text in matches:
+        print(f"{number}\t{vsr_name}\t{table}.{domain}\t{user}\t{next_text}")
+elapsed = time.perf_counter() - start
+print(
+    f"{found}/{len(numbers)} number(s) routed, {len(indexes)} LRT(s) searched, "
+    f"index loaded in {loaded:.3f}s, {elapsed / len(numbers) * 1e6:.1f}us per lookup"
+)
@@ -0,0 +1,114 @@
+import argparse
+
+from functions_backup import format_backup, list_backups, prune_backups
+from functions_edit_lrt import (
+    LRT_TABLES,
+    MAX_WORKERS,
+    create_custom_logger,
+    find_rollback_targets,
+    parse_time,
+    rollback_lrt_vsr,
+)
+from constants import LOG_PATH, VSR_NAME
+
+parser = argparse.ArgumentParser(prog="Rollback LRT")
+parser.add_argument(
+    "-d", "--domain", dest="domain", help="Customer's domain of the LRT(s)"
+)
+parser.add_argument(
+    "-t",
+    "--tables",
+    dest="tables",
+    nargs="+",
+    type=str.upper,
+    choices=list(LRT_TABLES),
+    help="LRT(s) to roll back",
+)
+parser.add_argument(
+    "-v",
+    "--vsrs",
+    dest="vsrs",
+    nargs="+",
+    type=str.lower,
+    choices=VSR_NAME,
+    help="Session Router(s) to roll back",
+)
+parser.add_argument(
+    "--at",
+    dest="before",
+    type=parse_time,
+    help="Restore the latest backup taken at or before this time "
+    "(dd/mm/YYYY [HH:MM:SS], default: the latest backup)",
+)
+parser.add_argument(
+    "--sha",
+    dest="sha256",
+    help="Restore the backup whose SHA-256 starts with this prefix",
+)
+parser.add_argument(
+    "-l", "--list", action="store_true", help="List the backups and exit"
+)
+parser.add_argument(
+    "--prune",
+    action="store_true",
+    help="Apply the backup retention policy and exit",
+)
+parser.add_argument(
+    "-w",
+    "--workers",
+    dest="workers",
+    default=MAX_WORKERS,
+    type=int,
+    help=f"Number of VSRs to roll back at the same time (default: {MAX_WORKERS})",
+)
+parser.add_argument(
+    "-y", "--yes", action="store_true", help="Do not ask for confirmation"
+)
+args = parser.parse_args()
+
+if args.prune:
+    backups, blobs = prune_backups()
+    print(f"Pruned {backups} backup(s), {blobs} blob(s) removed")
+    parser.exit()
+
+if args.list:
+    for record in list_backups(domain=args.domain, before=args.before):
+        if (not args.tables or record["table"] in args.tables) and (
+            not args.vsrs or record["vsr"] in args.vsrs
+        ):
+            print(format_backup(record))
+    parser.exit()
+
+if not (args.domain and args.tables and args.vsrs):
+    parser.error("the following arguments are required: -d, -t, -v")
+
+plan, fails = find_rollback_targets(
+    args.domain, args.tables, args.vsrs, args.before, args.sha256
+)
+for vsr_name, errors in fails.items():
+    print(f"{vsr_name}: {', '.join(errors)}")
+if not plan:
+    parser.exit(1, "Nothing to roll back\n")
+
+print("Backups to restore:")
+for targets in plan.values():
+    for record in targets.values():
+        print(format_backup(record))
+if not args.yes and input("Proceed? [y/N]: ").lower() != "y":
+    parser.exit(0, "Rollback cancelled\n")
+
+# Initiate our custom logger for this task
+my_logger, my_logfile = create_custom_logger("Rollback", LOG_PATH)
+my_logger.info(
+    "Task inputs: \n"
+    "Task selected: Rollback LRT(s) \n"
+    f"Customer domain: {args.domain} \n"
+    f"Session Router(s) to work: {list(plan)} \n"
+    f"LRT(s) to work: {args.tables} \n"
+)
+
+errors = rollback_lrt_vsr(plan, my_logger, args.workers)
+errors.update(fails)
+if errors:
+    print(f"Rollback completed with errors in {', '.join(errors)}.")
+    print(f"Please verify logfile {my_logfile}")